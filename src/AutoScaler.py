@@ -0,0 +1,176 @@
+"""
+If you use and like our software, please send us a postcard! ^^
+
+Copyright (C) 2009, 2010, Zhang Initiative Research Unit,
+Advance Science Institute, Riken
+2-1 Hirosawa, Wako, Saitama 351-0198, Japan
+---
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+---
+Number of jobs run at the same time on this node, tuned while jobs run
+(parallel.py --autoscale MAX).
+
+The number of jobs done per minute is measured over periods of at least
+sample_period seconds. After each period the number of jobs is moved one
+step up or down: it keeps going the same way while the rate improves,
+turns back when the rate drops and then stays there. When the rate does
+not change, the CPU usage from /proc/stat decides: spare CPU without much
+I/O wait means one more job, a busy CPU after going up means going back
+down, and a high I/O wait means staying there, the disk being the
+bottleneck. When the available memory gets low, the number of jobs goes
+down whatever the rate.
+"""
+
+import time
+
+from threading import Condition, Thread
+from LoadProbe import read_free_memory
+
+sample_period = 20.0 # seconds, at least
+rate_noise    = 0.05 # relative changes of the rate smaller than that are
+                     # not considered as changes
+busy_cpu      = 0.9  # CPU usage over which more jobs won't run faster
+high_iowait   = 0.2  # share of CPU time waiting for I/O
+
+# (busy, iowait, total) CPU times since boot
+def read_cpu_times():
+    f = open("/proc/stat", 'r')
+    fields = map(int, f.readline().split()[1:])
+    f.close()
+    idle   = fields[3]
+    iowait = 0
+    if len(fields) > 4:
+        iowait = fields[4]
+    total = sum(fields[:8]) # guest times are already in user and nice
+    return (total - idle - iowait, iowait, total)
+
+class AutoScaler(Thread):
+
+    def __init__(self, nb_jobs, max_jobs, min_free_mem):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.limit        = nb_jobs # jobs allowed to run at the same time
+        self.max_jobs     = max_jobs
+        self.min_free_mem = min_free_mem
+        self.cond         = Condition()
+        self.nb_running   = 0 # slots taken, with worker threads
+        self.nb_done      = 0
+        self.direction    = 1 # of the last change
+        self.turned_back  = False
+        self.last_rate    = None
+        self.listeners    = [] # called when the limit goes up
+        self.history      = [] # (limit, jobs per minute) of each period
+
+    # take a slot, blocks while all the slots are taken
+    def acquire(self):
+        self.cond.acquire()
+        while self.nb_running >= self.limit:
+            self.cond.wait()
+        self.nb_running += 1
+        self.cond.release()
+
+    def release(self):
+        self.cond.acquire()
+        self.nb_running -= 1
+        self.cond.notify()
+        self.cond.release()
+
+    # False if the slot was given back because the limit went down
+    def keep_slot(self):
+        self.cond.acquire()
+        res = self.nb_running <= self.limit
+        if not res:
+            self.nb_running -= 1
+        self.cond.release()
+        return res
+
+    def job_done(self):
+        self.cond.acquire()
+        self.nb_done += 1
+        self.cond.release()
+
+    # next number of jobs after a period with that rate and CPU usage
+    def next_limit(self, rate, busy, iowait, free_mem):
+        if free_mem < self.min_free_mem:
+            self.direction = -1
+        elif self.last_rate is None:
+            if busy < busy_cpu and iowait < high_iowait:
+                self.direction = 1
+            else:
+                self.direction = 0
+        elif rate < (1.0 - rate_noise) * self.last_rate:
+            if self.direction == 0:
+                self.direction = -1
+            else:
+                self.direction = -self.direction # that was worse
+                self.turned_back = True
+        elif self.turned_back:
+            # back where it was better, stay there
+            self.direction   = 0
+            self.turned_back = False
+        elif rate <= (1.0 + rate_noise) * self.last_rate:
+            # no real change
+            if busy < busy_cpu and iowait < high_iowait:
+                self.direction = 1
+            elif self.direction == 1 and busy >= busy_cpu:
+                self.direction = -1 # more jobs only compete for the CPU
+            else:
+                self.direction = 0
+        self.last_rate = rate
+        return max(1, min(self.max_jobs, self.limit + self.direction))
+
+    def run(self):
+        (last_busy, last_iowait, last_total) = read_cpu_times()
+        last_time = time.time()
+        while True:
+            time.sleep(sample_period)
+            self.cond.acquire()
+            nb_done = self.nb_done
+            limit   = self.limit
+            self.cond.release()
+            # long jobs need longer periods to measure anything
+            if (nb_done < limit and
+                time.time() - last_time < 10 * sample_period):
+                continue
+            (busy, iowait, total) = read_cpu_times()
+            free_mem = read_free_memory()
+            ticks    = max(1, total - last_total)
+            now      = time.time()
+            rate     = 60.0 * nb_done / (now - last_time)
+            self.history.append((limit, rate))
+            new_limit = self.next_limit(rate,
+                                        float(busy - last_busy) / ticks,
+                                        float(iowait - last_iowait) / ticks,
+                                        free_mem)
+            self.cond.acquire()
+            self.nb_done = 0
+            self.limit   = new_limit
+            self.cond.notifyAll()
+            self.cond.release()
+            if new_limit > limit:
+                for listener in self.listeners:
+                    listener()
+            (last_busy, last_iowait, last_total) = (busy, iowait, total)
+            last_time = now
+
+    def report(self):
+        best = None
+        for (limit, rate) in self.history:
+            if best is None or rate > best[1]:
+                best = (limit, rate)
+        res = "%d jobs at the end" % self.limit
+        if best:
+            res += ", best rate %.1f jobs/min with %d jobs" % (best[1],
+                                                               best[0])
+        return res
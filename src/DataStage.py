@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+
+"""
+If you use and like our software, please send us a postcard! ^^
+
+Copyright (C) 2009, 2010, Zhang Initiative Research Unit,
+Advance Science Institute, Riken
+2-1 Hirosawa, Wako, Saitama 351-0198, Japan
+---
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+---
+Staging of input data on the nodes (parallel.py -s --stage FILE), so that
+all the nodes don't pull the same big files from the server at the same
+time.
+
+The server splits each staged file in chunks and tracks which node has or
+is fetching which chunk. When a node asks which chunk to fetch next, the
+server gives one that other nodes have, the rarest first, so that nodes
+serve each other; else one that no node is fetching yet, from the server;
+else the node waits for the chunks being fetched by others, so that the
+server sends each chunk as few times as possible. Chunks are checked
+against their md5 and served by a node as soon as it has them: the more
+nodes fetch a file, the more nodes serve it.
+
+The protocol is one request line per TCP connection, with PORT the one
+the asking node serves chunks on:
+  LIST                    -> names of the staged files
+  MANIFEST NAME           -> size, chunk size, md5 of each chunk
+  NEXT NAME PORT          -> 'CHUNK I HOST:PORT...' with the nodes having
+                             chunk I, 'WAIT' or 'DONE'
+  HAVE NAME I PORT        -> OK, the asking node has chunk I
+  GET NAME I              -> length of chunk I then its bytes,
+                             -1 if not there
+only the server answers the first four.
+
+Without parallel.py, like the timings of tests/nfs_time.sh:
+  DataStage.py serve FILE...                 (on the server)
+  DataStage.py get SERVER NAME DEST          (on each node)
+"""
+
+import os, random, socket, sys, thread, time
+
+import SocketServer
+
+try:
+    from hashlib import md5
+except ImportError: # python 2.4
+    from md5 import new as md5
+
+from optparse  import OptionParser
+from threading import Thread
+
+default_port = 52433
+chunk_size   = 1024 * 1024
+piece_size   = 64 * 1024 # sent at once, so that throttling is smooth
+nb_fetchers  = 4         # chunks fetched at the same time by a node
+nb_retries   = 10        # rounds over the sources of a chunk
+max_fetch    = 60.0      # seconds after which a fetch is considered lost
+io_timeout   = 30.0      # seconds a silent node is given, then it failed
+
+# limits the upload rate of a node, for all its connections
+class Throttle:
+
+    # rate in bytes per second, 0 means no limit
+    def __init__(self, rate = 0):
+        self.rate      = rate
+        self.lock      = thread.allocate_lock()
+        self.next_time = time.time()
+
+    def spend(self, nb_bytes):
+        if self.rate <= 0:
+            return
+        self.lock.acquire()
+        now   = time.time()
+        start = max(now, self.next_time)
+        self.next_time = start + float(nb_bytes) / self.rate
+        wait  = self.next_time - now
+        self.lock.release()
+        if wait > 0:
+            time.sleep(wait)
+
+# a file being staged, have tells the chunks there are in path
+class StagedFile:
+
+    def __init__(self, path, size, hashes, have):
+        self.path   = path
+        self.size   = size
+        self.hashes = hashes
+        self.have   = have # chunk index -> True
+        self.lock   = thread.allocate_lock()
+
+    def read_chunk(self, index):
+        f = open(self.path, 'rb')
+        f.seek(index * chunk_size)
+        res = f.read(chunk_size)
+        f.close()
+        return res
+
+    def write_chunk(self, index, data):
+        self.lock.acquire()
+        f = open(self.path, 'r+b')
+        f.seek(index * chunk_size)
+        f.write(data)
+        f.close()
+        self.have[index] = True
+        self.lock.release()
+
+def staged_from_file(path):
+    hashes = []
+    f = open(path, 'rb')
+    data = f.read(chunk_size)
+    while data:
+        hashes.append(md5(data).hexdigest())
+        data = f.read(chunk_size)
+    f.close()
+    have = {}
+    for i in range(len(hashes)):
+        have[i] = True
+    return StagedFile(path, os.path.getsize(path), hashes, have)
+
+class StageHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        words  = self.rfile.readline().split()
+        server = self.server
+        if not words:
+            return
+        if words[0] == "GET" and len(words) == 3:
+            self.send_chunk(server.files.get(words[1]), int(words[2]))
+        elif server.tracker is None:
+            self.wfile.write("error: not the server\n")
+        elif words[0] == "LIST":
+            self.wfile.write(" ".join(server.files.keys()) + "\n")
+        elif words[0] == "MANIFEST" and len(words) == 2:
+            staged = server.files[words[1]]
+            self.wfile.write("%d %d %s\n" % (staged.size, chunk_size,
+                                             " ".join(staged.hashes)))
+        elif words[0] == "NEXT" and len(words) == 3:
+            node = (self.client_address[0], int(words[2]))
+            self.wfile.write(server.next_chunk(words[1], node) + "\n")
+        elif words[0] == "HAVE" and len(words) == 4:
+            server.add_source(words[1], int(words[2]),
+                              (self.client_address[0], int(words[3])))
+            self.wfile.write("OK\n")
+        else:
+            self.wfile.write("error: bad request\n")
+
+    def send_chunk(self, staged, index):
+        data = None
+        if staged is not None and staged.have.has_key(index):
+            try:
+                data = staged.read_chunk(index)
+            except IOError: # being renamed, ask someone else
+                pass
+        if data is None:
+            self.wfile.write("-1\n")
+            return
+        self.wfile.write("%d\n" % len(data))
+        for i in range(0, len(data), piece_size):
+            self.server.throttle.spend(min(piece_size, len(data) - i))
+            self.wfile.write(data[i:i + piece_size])
+
+# serves chunks from its own threads; the server of the run is also the
+# tracker of who has which chunk
+class StageServer(SocketServer.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads      = True
+
+    # port 0 picks a free port, rate limits uploads in bytes per second
+    def __init__(self, port = 0, is_tracker = False, rate = 0):
+        SocketServer.ThreadingTCPServer.__init__(self, ("", port),
+                                                 StageHandler)
+        self.files    = {} # name -> StagedFile
+        self.throttle = Throttle(rate)
+        self.tracker  = None
+        if is_tracker:
+            # name -> for each chunk, ([nodes having it],
+            #                          {node fetching it : since when})
+            self.tracker      = {}
+            self.tracker_lock = thread.allocate_lock()
+
+    def port(self):
+        return self.server_address[1]
+
+    def publish(self, path):
+        name = os.path.basename(path)
+        if self.files.has_key(name):
+            raise ValueError("two staged files are named %s" % name)
+        self.files[name] = staged = staged_from_file(path)
+        self.tracker[name] = [([], {}) for h in staged.hashes]
+
+    # what node should fetch next
+    def next_chunk(self, name, node):
+        now        = time.time()
+        from_peers = None # (nb of nodes with it or fetching it, index)
+        from_us    = []   # chunks nobody fetches, from the server
+        waiting    = False
+        self.tracker_lock.acquire()
+        chunks = self.tracker[name]
+        for index in range(len(chunks)):
+            (holders, fetching) = chunks[index]
+            if node in holders or fetching.has_key(node):
+                continue
+            for (other, since) in fetching.items():
+                if now - since > max_fetch: # that node died
+                    del fetching[other]
+            if holders:
+                rarity = (len(holders) + len(fetching), index)
+                if from_peers is None or rarity < from_peers:
+                    from_peers = rarity
+            elif not fetching:
+                from_us.append(index)
+            else:
+                waiting = True
+        if from_peers is not None:
+            index = from_peers[1]
+        elif from_us:
+            index = random.choice(from_us)
+        else:
+            index = None
+        if index is not None:
+            chunks[index][1][node] = now
+            holders = chunks[index][0][:]
+        self.tracker_lock.release()
+        if index is not None:
+            return "CHUNK %d %s" % (index, " ".join(["%s:%d" % other
+                                                     for other in holders]))
+        if waiting:
+            return "WAIT"
+        return "DONE"
+
+    def add_source(self, name, index, node):
+        self.tracker_lock.acquire()
+        (holders, fetching) = self.tracker[name][index]
+        holders.append(node)
+        fetching.pop(node, None)
+        self.tracker_lock.release()
+
+    def start(self):
+        t = Thread(target = self.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+# sends a request line, returns the answer file; a node that stops
+# answering raises socket.timeout, a socket.error
+def request(address, line):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(io_timeout)
+    s.connect(address)
+    s.sendall(line)
+    answer = s.makefile('rb')
+    s.close() # answer keeps the connection open
+    return answer
+
+def ask(address, line):
+    answer = request(address, line)
+    res = answer.readline()
+    answer.close()
+    return res
+
+# the chunk from that node, None if it doesn't have it or failed
+def get_chunk(address, name, index, expected_hash):
+    try:
+        answer = request(address, "GET %s %d\n" % (name, index))
+        length = int(answer.readline())
+        data   = None
+        if length >= 0:
+            data = answer.read(length)
+        answer.close()
+    except (socket.error, IOError, ValueError):
+        return None
+    if data is None or md5(data).hexdigest() != expected_hash:
+        return None
+    return data
+
+def parse_address(node):
+    (host, port) = node.split(":")
+    return (host, int(port))
+
+# fetches a file from the nodes having its chunks and from the server,
+# the chunks are served by peer as soon as they are here
+class Fetcher:
+
+    # without peers, all chunks come from the server
+    def __init__(self, server_address, peer, use_peers = True):
+        self.server    = server_address
+        self.peer      = peer
+        self.use_peers = use_peers
+
+    def fetch_chunk(self, name, staged, index, sources):
+        random.shuffle(sources)
+        for i in range(nb_retries):
+            for address in sources + [self.server]:
+                data = get_chunk(address, name, index, staged.hashes[index])
+                if data is not None:
+                    staged.write_chunk(index, data)
+                    ask(self.server, "HAVE %s %d %d\n" %
+                        (name, index, self.peer.port()))
+                    return
+            time.sleep(1.0)
+        raise IOError("could not fetch chunk %d of %s" % (index, name))
+
+    # one of the fetching threads
+    def fetch_chunks(self, name, staged, todo, lock, errors):
+        while not errors:
+            if self.use_peers:
+                answer = ask(self.server, "NEXT %s %d\n" %
+                             (name, self.peer.port())).split()
+            else:
+                lock.acquire()
+                answer = ["DONE"]
+                if todo:
+                    answer = ["CHUNK", todo.pop()]
+                lock.release()
+            if not answer or answer[0] == "DONE":
+                return
+            if answer[0] == "WAIT":
+                time.sleep(0.1)
+                continue
+            try:
+                self.fetch_chunk(name, staged, int(answer[1]),
+                                 map(parse_address, answer[2:]))
+            except (socket.error, IOError), e:
+                errors.append(e)
+
+    def fetch(self, name, dest):
+        manifest = ask(self.server, "MANIFEST %s\n" % name).split()
+        size     = int(manifest[0])
+        hashes   = manifest[2:]
+        part     = dest + ".part"
+        f = open(part, 'wb')
+        f.truncate(size)
+        f.close()
+        staged = StagedFile(part, size, hashes, {})
+        self.peer.files[name] = staged
+        todo    = range(len(hashes))
+        random.shuffle(todo)
+        lock    = thread.allocate_lock()
+        errors  = []
+        threads = []
+        for i in range(min(nb_fetchers, len(hashes))):
+            t = Thread(target = self.fetch_chunks,
+                       args = (name, staged, todo, lock, errors))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        staged.lock.acquire()
+        os.rename(part, dest)
+        staged.path = dest
+        staged.lock.release()
+
+# on a node, fetches all the staged files of the server in directory and
+# returns the StageServer which serves them to the other nodes, or None
+# when the server stages nothing
+def stage_from(server_address, directory):
+    try:
+        names = ask(server_address, "LIST\n").split()
+    except socket.error: # not staging
+        return None
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    peer = StageServer()
+    peer.start()
+    fetcher = Fetcher(server_address, peer)
+    for name in names:
+        fetcher.fetch(name, os.path.join(directory, name))
+    return peer
+
+# the server's own jobs see the staged files in directory too
+def link_all(paths, directory):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for path in paths:
+        link = os.path.join(directory, os.path.basename(path))
+        if os.path.islink(link):
+            os.remove(link)
+        os.symlink(os.path.abspath(path), link)
+
+if __name__ == '__main__':
+    my_parser = OptionParser(usage = "Usage: %prog serve FILE...\n"
+                             "       %prog get SERVER NAME DEST")
+    my_parser.add_option("-p", "--port",
+                         dest = "port", default = default_port, type = "int",
+                         help = "port of the server")
+    my_parser.add_option("-r", "--rate",
+                         dest = "rate", default = 0, type = "float",
+                         help = "upload limit in MB/s (default is none)")
+    my_parser.add_option("--linger",
+                         dest = "linger", default = 0, type = "float",
+                         help = ("get: seconds to keep serving chunks to "
+                                 "other nodes once the file is here"))
+    my_parser.add_option("--no-peers",
+                         action = "store_true", dest = "no_peers",
+                         default = False,
+                         help = "get: only fetch from the server")
+    (options, optargs) = my_parser.parse_args()
+    rate = int(options.rate * 1024 * 1024)
+    if len(optargs) >= 2 and optargs[0] == "serve":
+        server = StageServer(options.port, True, rate)
+        for path in optargs[1:]:
+            server.publish(path)
+        server.serve_forever()
+    elif len(optargs) == 4 and optargs[0] == "get":
+        peer = StageServer(0, False, rate)
+        peer.start()
+        start = time.time()
+        Fetcher((optargs[1], options.port), peer,
+                not options.no_peers).fetch(optargs[2], optargs[3])
+        print "real %.3f" % (time.time() - start)
+        sys.stdout.flush()
+        time.sleep(options.linger)
+    else:
+        my_parser.print_help()
+        sys.exit(1)
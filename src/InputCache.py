@@ -0,0 +1,215 @@
+"""
+If you use and like our software, please send us a postcard! ^^
+
+Copyright (C) 2009, 2010, Zhang Initiative Research Unit,
+Advance Science Institute, Riken
+2-1 Hirosawa, Wako, Saitama 351-0198, Japan
+---
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+---
+Local copies of the input files of jobs (parallel.py --input-cache DIR),
+so that jobs of a node reading the same files over NFS again and again
+read them from a local disk instead.
+
+A job declares an input file with {in:PATH} in its command, e.g.
+  dock {in:/nfs/db/receptor.pdb} ligand_42.mol2
+and its command is run with the path of the local copy instead:
+  dock DIR/3f/3f2a.../receptor.pdb ligand_42.mol2
+PATH is copied the first time a job of the node needs it, to
+DIR/xx/HASH/NAME, HASH being the md5 of its contents, so that identical
+files are only kept once (their other names are hard links). It is
+copied again when its size or modification time changed. When the copies
+take more than the maximum size, the least recently used ones are
+removed, except those used by running jobs. If PATH can't be copied, the
+job gets PATH itself, as do jobs of nodes without --input-cache.
+"""
+
+import os, re, shutil, thread, time
+
+try:
+    from hashlib import md5
+except ImportError: # python 2.4
+    from md5 import new as md5
+
+from threading import Condition
+
+# an input file declared in a command
+declared_input = re.compile(r"\{in:([^}]+)\}")
+
+class InputCache:
+
+    def __init__(self, directory, max_bytes):
+        self.directory  = directory
+        self.max_bytes  = max_bytes
+        self.cond       = Condition()
+        self.known      = {} # path -> (size, mtime, hash)
+        self.entries    = {} # hash -> [size, last use]
+        self.nb_bytes   = 0
+        self.pins       = {} # hash -> number of running jobs using it
+        self.fetching   = {} # paths being copied
+        self.nb_hits    = 0
+        self.nb_misses  = 0
+        self.nb_evicted = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for sub_name in os.listdir(directory):
+            sub_dir = os.path.join(directory, sub_name)
+            if len(sub_name) != 2 or not os.path.isdir(sub_dir):
+                continue
+            for h in os.listdir(sub_dir):
+                # the names of a copy are hard links
+                names = os.listdir(os.path.join(sub_dir, h))
+                if not names:
+                    continue
+                size = os.path.getsize(os.path.join(sub_dir, h, names[0]))
+                last = os.path.getmtime(os.path.join(sub_dir, h))
+                self.entries[h] = [size, last]
+                self.nb_bytes  += size
+        # what was known by previous runs, the last line of a path wins
+        self.index_name = os.path.join(directory, "index")
+        if os.path.exists(self.index_name):
+            index_file = open(self.index_name, 'r')
+            for line in index_file:
+                fields = line.rstrip("\n").split(" ", 3)
+                if len(fields) == 4:
+                    self.known[fields[3]] = (int(fields[0]),
+                                             float(fields[1]), fields[2])
+            index_file.close()
+
+    def path(self, h, name):
+        return os.path.join(self.directory, h[:2], h, name)
+
+    # copies path to the cache, returns the hash of its contents
+    def fetch(self, path, size, mtime):
+        tmp_dir = os.path.join(self.directory, "tmp.%d.%d" %
+                               (os.getpid(), thread.get_ident()))
+        os.mkdir(tmp_dir)
+        try:
+            h   = md5()
+            src = open(path, 'rb')
+            dst = open(os.path.join(tmp_dir, os.path.basename(path)), 'wb')
+            data = src.read(1024 * 1024)
+            while data:
+                h.update(data)
+                dst.write(data)
+                data = src.read(1024 * 1024)
+            src.close()
+            dst.close()
+            h = h.hexdigest()
+            final_dir = os.path.dirname(self.path(h, "x"))
+            if os.path.isdir(final_dir): # same contents, other path
+                shutil.rmtree(tmp_dir)
+                # the copy there may have another name
+                if not os.path.exists(self.path(h, os.path.basename(path))):
+                    os.link(self.path(h, os.listdir(final_dir)[0]),
+                            self.path(h, os.path.basename(path)))
+            else:
+                if not os.path.isdir(os.path.dirname(final_dir)):
+                    os.mkdir(os.path.dirname(final_dir))
+                os.rename(tmp_dir, final_dir)
+        except EnvironmentError:
+            shutil.rmtree(tmp_dir, True)
+            raise
+        index_file = open(self.index_name, 'a')
+        index_file.write("%d %r %s %s\n" % (size, mtime, h, path))
+        index_file.close()
+        return h
+
+    # local path of the copy of path, pinned until release;
+    # None if there can't be one
+    def acquire(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        name = os.path.basename(path)
+        self.cond.acquire()
+        # one copy at a time of a given path
+        while self.fetching.has_key(path):
+            self.cond.wait()
+        known = self.known.get(path)
+        if (known and known[0] == stat.st_size and
+            known[1] == stat.st_mtime and self.entries.has_key(known[2]) and
+            os.path.exists(self.path(known[2], name))):
+            h = known[2]
+            self.entries[h][1] = time.time()
+            self.nb_hits += 1
+        else:
+            self.nb_misses += 1
+            self.fetching[path] = True
+            self.cond.release()
+            try:
+                h = self.fetch(path, stat.st_size, stat.st_mtime)
+            except EnvironmentError:
+                h = None
+            self.cond.acquire()
+            del self.fetching[path]
+            self.cond.notifyAll()
+            if h is None:
+                self.cond.release()
+                return None
+            self.known[path] = (stat.st_size, stat.st_mtime, h)
+            if self.entries.has_key(h):
+                self.entries[h][1] = time.time()
+            else:
+                self.entries[h] = [stat.st_size, time.time()]
+                self.nb_bytes  += stat.st_size
+        self.pins[h] = self.pins.get(h, 0) + 1
+        self.evict()
+        self.cond.release()
+        try:
+            # the modification time is the last use when loading
+            os.utime(os.path.dirname(self.path(h, name)), None)
+        except OSError:
+            pass
+        return (h, self.path(h, name))
+
+    def release(self, h):
+        self.cond.acquire()
+        self.pins[h] -= 1
+        if self.pins[h] == 0:
+            del self.pins[h]
+        self.evict()
+        self.cond.release()
+
+    # cond must be held
+    def evict(self):
+        if self.nb_bytes <= self.max_bytes:
+            return
+        by_use = [(use, h) for (h, (size, use)) in self.entries.items()
+                  if not self.pins.has_key(h)]
+        by_use.sort()
+        for (use, h) in by_use:
+            if self.nb_bytes <= 0.9 * self.max_bytes:
+                break
+            shutil.rmtree(os.path.dirname(self.path(h, "x")), True)
+            self.nb_bytes -= self.entries.pop(h)[0]
+            self.nb_evicted += 1
+
+    # the command with the local copies of its inputs, and what to release
+    # once it has run
+    def localize(self, cmd):
+        pinned = []
+        def local_path(match):
+            res = self.acquire(match.group(1))
+            if res is None:
+                return match.group(1)
+            pinned.append(res[0])
+            return res[1]
+        return (declared_input.sub(local_path, cmd), pinned)
+
+    def report(self):
+        return ("%d hits, %d copies, %d evicted, %.1f MB used" %
+                (self.nb_hits, self.nb_misses, self.nb_evicted,
+                 self.nb_bytes / (1024.0 * 1024.0)))
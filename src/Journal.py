@@ -0,0 +1,104 @@
+"""
+If you use and like our software, please send us a postcard! ^^
+
+Copyright (C) 2009, 2010, Zhang Initiative Research Unit,
+Advance Science Institute, Riken
+2-1 Hirosawa, Wako, Saitama 351-0198, Japan
+---
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+---
+Append-only journal of the jobs whose output was written, so that an
+interrupted run can be resumed (parallel.py --journal FILE --resume).
+
+One line per job: its job id and the hash of its command.
+Every second or every 1000 jobs the output file is flushed to disk, then
+a 'commit OUTPUT_SIZE' line is written and the journal is flushed to disk.
+Only committed jobs are considered done when resuming, and the output is
+cut back to its committed size, so that it never has the partial output
+of a job which was not committed. The journal itself is cut back after
+its last commit, else the next commit would also count the jobs of the
+interrupted run which were not committed.
+"""
+
+import os, time
+
+from LogIndex import command_hash
+
+commit_period = 1.0  # seconds
+commit_size   = 1000 # jobs
+
+def hex_hash(cmd):
+    res = ""
+    for c in command_hash(cmd):
+        res += "%02x" % ord(c)
+    return res
+
+# (job id -> command hash of the committed jobs, committed output size,
+#  size of the journal up to its last commit)
+def read_journal(journal_file_name):
+    done         = {}
+    pending      = {}
+    output_size  = 0
+    journal_size = 0
+    offset       = 0
+    journal_file = open(journal_file_name, 'r')
+    for line in journal_file:
+        offset += len(line)
+        fields  = line.split()
+        if len(fields) != 2 or not line.endswith("\n"):
+            continue # the end of an interrupted write
+        if fields[0] == "commit":
+            done.update(pending)
+            pending      = {}
+            output_size  = int(fields[1])
+            journal_size = offset
+        else:
+            pending[int(fields[0])] = fields[1]
+    journal_file.close()
+    return (done, output_size, journal_size)
+
+class Journal:
+
+    # output_file and index_file are flushed to disk before each commit
+    def __init__(self, journal_file, output_file = None, index_file = None):
+        self.journal_file = journal_file
+        self.output_file  = output_file
+        self.index_file   = index_file
+        self.nb_pending   = 0
+        self.last_commit  = time.time()
+
+    def add(self, job_id, cmd):
+        self.journal_file.write("%d %s\n" % (job_id, hex_hash(cmd)))
+        self.nb_pending += 1
+        if (self.nb_pending >= commit_size or
+            time.time() - self.last_commit >= commit_period):
+            self.commit()
+
+    def commit(self):
+        output_size = 0
+        for f in [self.index_file, self.output_file]:
+            if f:
+                f.flush()
+                os.fsync(f.fileno())
+        if self.output_file:
+            output_size = self.output_file.tell()
+        self.journal_file.write("commit %d\n" % output_size)
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+        self.nb_pending  = 0
+        self.last_commit = time.time()
+
+    def close(self):
+        self.commit()
+        self.journal_file.close()
@@ -0,0 +1,167 @@
+"""
+If you use and like our software, please send us a postcard! ^^
+
+Copyright (C) 2009, 2010, Zhang Initiative Research Unit,
+Advance Science Institute, Riken
+2-1 Hirosawa, Wako, Saitama 351-0198, Japan
+---
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+---
+Watch the load of the node (parallel.py --load-probe SIGNAL), so that jobs
+don't make a shared machine thrash.
+
+Every few seconds the load average and the available memory are read from
+/proc. When the load is too high or memory too low, SIGNAL is sent to the
+process group of each running job and no more jobs are leased. When the
+node is back to normal, stopped jobs get SIGCONT and leasing goes on.
+SIGNAL can also be one a job catches to checkpoint itself.
+"""
+
+import os, signal, thread, time
+
+from threading import Event, Thread
+
+check_period = 5.0 # seconds
+resume_load  = 0.8 # of the maximum load, to resume
+resume_mem   = 1.5 # times the minimum free memory, to resume
+
+# signals after which a job needs SIGCONT to run again
+stop_signals = [signal.SIGSTOP, signal.SIGTSTP, signal.SIGTTIN,
+                signal.SIGTTOU]
+
+# a signal number from a number or a name, with or without SIG
+def signal_number(name):
+    if name.isdigit():
+        return int(name)
+    name = name.upper()
+    if not name.startswith("SIG"):
+        name = "SIG" + name
+    res = getattr(signal, name, None)
+    if not isinstance(res, int):
+        raise ValueError("unknown signal: %s" % name)
+    return res
+
+# 1 minute load average
+def read_load():
+    f = open("/proc/loadavg", 'r')
+    res = float(f.read().split()[0])
+    f.close()
+    return res
+
+# percentage of the memory which is available
+def read_free_memory():
+    fields = {}
+    f = open("/proc/meminfo", 'r')
+    for line in f:
+        words = line.split()
+        if len(words) >= 2:
+            fields[words[0].rstrip(":")] = int(words[1])
+    f.close()
+    if fields.has_key("MemAvailable"):
+        available = fields["MemAvailable"]
+    else: # older kernels
+        available = (fields.get("MemFree", 0) + fields.get("Buffers", 0) +
+                     fields.get("Cached", 0))
+    return (100.0 * available) / fields["MemTotal"]
+
+class LoadProbe(Thread):
+
+    def __init__(self, pause_signal, max_load, min_free_mem):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.pause_signal = pause_signal
+        self.max_load     = max_load
+        self.min_free_mem = min_free_mem
+        self.lock         = thread.allocate_lock()
+        self.groups       = {} # process group ids of the running jobs
+        self.ok           = Event()
+        self.ok.set()
+        self.listeners    = [] # called when the node is back to normal
+        self.nb_pauses    = 0
+        self.paused_time  = 0.0
+        self.paused_since = None
+
+    def overloaded(self, load, free_mem):
+        return load > self.max_load or free_mem < self.min_free_mem
+
+    def recovered(self, load, free_mem):
+        return (load <= resume_load * self.max_load and
+                free_mem >= min(resume_mem * self.min_free_mem, 100.0))
+
+    def signal_group(self, group, sig):
+        try:
+            os.killpg(group, sig)
+        except OSError: # already gone
+            pass
+
+    # a job was started in its own process group
+    def add(self, group):
+        self.lock.acquire()
+        self.groups[group] = True
+        if not self.ok.isSet():
+            self.signal_group(group, self.pause_signal)
+        self.lock.release()
+
+    def remove(self, group):
+        self.lock.acquire()
+        self.groups.pop(group, None)
+        self.lock.release()
+
+    def is_ok(self):
+        return self.ok.isSet()
+
+    # blocks while the node is overloaded
+    def wait_ok(self):
+        self.ok.wait()
+
+    def pause(self):
+        self.lock.acquire()
+        self.ok.clear()
+        for group in self.groups.keys():
+            self.signal_group(group, self.pause_signal)
+        self.lock.release()
+        self.nb_pauses   += 1
+        self.paused_since = time.time()
+
+    def resume(self):
+        self.lock.acquire()
+        if self.pause_signal in stop_signals:
+            for group in self.groups.keys():
+                self.signal_group(group, signal.SIGCONT)
+        self.ok.set()
+        self.lock.release()
+        self.paused_time += time.time() - self.paused_since
+        self.paused_since = None
+        for listener in self.listeners:
+            listener()
+
+    def run(self):
+        while True:
+            time.sleep(check_period)
+            try:
+                load     = read_load()
+                free_mem = read_free_memory()
+            except (EnvironmentError, ValueError, KeyError): # no /proc
+                continue
+            if self.is_ok() and self.overloaded(load, free_mem):
+                self.pause()
+            elif not self.is_ok() and self.recovered(load, free_mem):
+                self.resume()
+
+    def report(self):
+        paused_time = self.paused_time
+        if self.paused_since is not None:
+            paused_time += time.time() - self.paused_since
+        return "paused %d times, %.1f s in total" % (self.nb_pauses,
+                                                     paused_time)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+If you use and like our software, please send us a postcard! ^^
+
+Copyright (C) 2009, 2010, Zhang Initiative Research Unit,
+Advance Science Institute, Riken
+2-1 Hirosawa, Wako, Saitama 351-0198, Japan
+---
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+---
+Index of a result log written with parallel.py -o LOG --index, in LOG.idx.
+
+Entry number i of the index is about job i (the command on line i + 1 of
+the commands file):
+  offset of its output in the log       8 bytes, big endian
+  length of its output in the log       8 bytes, big endian
+  hash of its command                   8 first bytes of its md5
+a zero length means there is no output for this job (yet).
+
+Print the output of one job, found without reading the log:
+  LogIndex.py LOG JOB_ID
+  LogIndex.py LOG -c COMMAND
+looking for a command reads the index, not the log.
+"""
+
+import mmap, struct, sys
+
+try:
+    from hashlib import md5
+except ImportError: # python 2.4
+    from md5 import new as md5
+
+from optparse   import OptionParser
+from RecordFile import decode, length_size, magic, to_text
+
+entry_format = ">QQ8s"
+entry_size   = struct.calcsize(entry_format)
+
+def command_hash(cmd):
+    return md5(cmd.rstrip("\n")).digest()[:8]
+
+def index_file_name(log_file_name):
+    return log_file_name + ".idx"
+
+class IndexWriter:
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+
+    def add(self, job_id, offset, length, cmd):
+        self.index_file.seek(job_id * entry_size)
+        self.index_file.write(struct.pack(entry_format, offset, length,
+                                          command_hash(cmd)))
+
+    # when resuming a run, the output of the jobs the previous run did not
+    # commit was cut from the log, their entries are cleared
+    def keep_only(self, done_jobs):
+        empty  = struct.pack(entry_format, 0, 0, "\0" * 8)
+        block  = 4096 # entries
+        first  = 0    # job id of the first entry of the block
+        while True:
+            self.index_file.seek(first * entry_size)
+            entries = self.index_file.read(block * entry_size)
+            if not entries:
+                break
+            for i in range(len(entries) / entry_size):
+                entry  = entries[i * entry_size:(i + 1) * entry_size]
+                length = struct.unpack(entry_format, entry)[1]
+                if length > 0 and not done_jobs.has_key(first + i):
+                    self.index_file.seek((first + i) * entry_size)
+                    self.index_file.write(empty)
+            first += block
+        self.index_file.seek(0, 2)
+
+# (offset, length) of the output of job_id in the log, None if not there
+def find_job(index_file, job_id):
+    index_file.seek(job_id * entry_size)
+    entry = index_file.read(entry_size)
+    if len(entry) < entry_size:
+        return None
+    (offset, length, cmd_hash) = struct.unpack(entry_format, entry)
+    if length == 0:
+        return None
+    return (offset, length)
+
+# job id of the first job with this command, None if not there
+def find_command(index_file, cmd):
+    wanted = command_hash(cmd)
+    index_file.seek(0)
+    job_id = 0
+    while True:
+        entry = index_file.read(entry_size)
+        if len(entry) < entry_size:
+            return None
+        (offset, length, cmd_hash) = struct.unpack(entry_format, entry)
+        if length > 0 and cmd_hash == wanted:
+            return job_id
+        job_id += 1
+
+# the output of a job as written in the log, records of a binary log
+# are converted to the text format
+def read_output(log_file, offset, length):
+    try:
+        log = mmap.mmap(log_file.fileno(), 0, access = mmap.ACCESS_READ)
+        res = log[offset:offset + length]
+        is_binary = log[:len(magic)] == magic
+        log.close()
+    except (EnvironmentError, OverflowError): # e.g. too big for 32 bits
+        log_file.seek(0)
+        is_binary = log_file.read(len(magic)) == magic
+        log_file.seek(offset)
+        res = log_file.read(length)
+    if is_binary:
+        (job_id, record) = decode(res[length_size:])
+        res = to_text(record)
+    return res
+
+if __name__ == '__main__':
+    my_parser = OptionParser(usage = "Usage: %prog LOG {JOB_ID | -c COMMAND}")
+    my_parser.add_option("-c", "--command",
+                         dest = "command", default = None,
+                         help = "look for the output of this command")
+    (options, optargs) = my_parser.parse_args()
+    if not ((len(optargs) == 1 and options.command) or
+            (len(optargs) == 2 and not options.command)):
+        my_parser.print_help()
+        sys.exit(1)
+    log_file   = open(optargs[0], 'rb')
+    index_file = open(index_file_name(optargs[0]), 'rb')
+    if options.command:
+        job_id = find_command(index_file, options.command)
+    else:
+        job_id = int(optargs[1])
+    where = None
+    if job_id is not None:
+        where = find_job(index_file, job_id)
+    if where is None:
+        sys.stderr.write("no such job in %s\n" % optargs[0])
+        sys.exit(1)
+    sys.stdout.write(read_output(log_file, where[0], where[1]))
+    index_file.close()
+    log_file.close()
@@ -0,0 +1,192 @@
+"""
+If you use and like our software, please send us a postcard! ^^
+
+Copyright (C) 2009, 2010, Zhang Initiative Research Unit,
+Advance Science Institute, Riken
+2-1 Hirosawa, Wako, Saitama 351-0198, Japan
+---
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+---
+Counters and histograms of the master, served over HTTP in the Prometheus
+text format (parallel.py -s --metrics-port PORT), e.g.:
+  curl http://SERVER_NAME:PORT/metrics
+
+A labeled counter is one counter per value of its label, e.g.
+  par_client_jobs_done_total{client="10.0.0.7:41862"} 1234
+
+Each counter and histogram has its own small lock, held only to add one
+value or to copy it for a scrape. Gauges are functions called at scrape
+time, they must not take the master's locks.
+"""
+
+import bisect, thread
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from threading      import Thread
+
+class Counter:
+
+    def __init__(self, name, help):
+        self.name  = name
+        self.help  = help
+        self.lock  = thread.allocate_lock()
+        self.value = 0
+
+    def add(self, amount = 1):
+        self.lock.acquire()
+        self.value += amount
+        self.lock.release()
+
+    def render(self):
+        return ("# HELP %s %s\n# TYPE %s counter\n%s %s\n" %
+                (self.name, self.help, self.name, self.name, self.value))
+
+# one counter per value of label, values appear as they are added to
+class LabeledCounter:
+
+    def __init__(self, name, help, label):
+        self.name   = name
+        self.help   = help
+        self.label  = label
+        self.lock   = thread.allocate_lock()
+        self.values = {} # label value -> count
+
+    def add(self, label_value, amount = 1):
+        self.lock.acquire()
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+        self.lock.release()
+
+    def render(self):
+        self.lock.acquire()
+        values = self.values.items()
+        self.lock.release()
+        values.sort()
+        res = "# HELP %s %s\n# TYPE %s counter\n" % (self.name, self.help,
+                                                     self.name)
+        for (label_value, count) in values:
+            label_value = label_value.replace("\\", "\\\\")
+            label_value = label_value.replace('"', '\\"')
+            res += '%s{%s="%s"} %s\n' % (self.name, self.label, label_value,
+                                         count)
+        return res
+
+class Gauge:
+
+    def __init__(self, name, help, fun):
+        self.name = name
+        self.help = help
+        self.fun  = fun
+
+    def render(self):
+        return ("# HELP %s %s\n# TYPE %s gauge\n%s %s\n" %
+                (self.name, self.help, self.name, self.name, self.fun()))
+
+class Histogram:
+
+    # buckets are the increasing upper bounds, +Inf is added
+    def __init__(self, name, help, buckets):
+        self.name    = name
+        self.help    = help
+        self.buckets = buckets
+        self.lock    = thread.allocate_lock()
+        self.counts  = [0] * (len(buckets) + 1) # not cumulative
+        self.sum     = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        self.lock.acquire()
+        self.counts[i] += 1
+        self.sum       += value
+        self.lock.release()
+
+    def render(self):
+        self.lock.acquire()
+        counts = self.counts[:]
+        total  = self.sum
+        self.lock.release()
+        res = "# HELP %s %s\n# TYPE %s histogram\n" % (self.name, self.help,
+                                                        self.name)
+        cumulated = 0
+        for (bound, count) in zip(self.buckets + ["+Inf"], counts):
+            cumulated += count
+            res += '%s_bucket{le="%s"} %d\n' % (self.name, bound, cumulated)
+        res += "%s_sum %f\n%s_count %d\n" % (self.name, total, self.name,
+                                              cumulated)
+        return res
+
+class Metrics:
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help):
+        res = Counter(name, help)
+        self.metrics.append(res)
+        return res
+
+    def labeled_counter(self, name, help, label):
+        res = LabeledCounter(name, help, label)
+        self.metrics.append(res)
+        return res
+
+    def gauge(self, name, help, fun):
+        res = Gauge(name, help, fun)
+        self.metrics.append(res)
+        return res
+
+    def histogram(self, name, help, buckets):
+        res = Histogram(name, help, buckets)
+        self.metrics.append(res)
+        return res
+
+    def render(self):
+        return "".join([m.render() for m in self.metrics])
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # scrapes are not worth a line on stderr
+
+# serves metrics from its own thread, one scrape at a time, until stop
+class MetricsServer(Thread):
+
+    def __init__(self, port, metrics):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.httpd = HTTPServer(("", port), MetricsHandler)
+        self.httpd.metrics = metrics
+        # accept gives up every second to look at stopped, serve_forever
+        # can't be stopped in python 2.4
+        self.httpd.socket.settimeout(1.0)
+        self.stopped = False
+
+    def run(self):
+        while not self.stopped:
+            self.httpd.handle_request()
+        self.httpd.server_close()
+
+    def stop(self):
+        self.stopped = True
+        self.join()
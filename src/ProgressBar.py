@@ -19,33 +19,99 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import sys
+import math, sys, time
 
+min_period = 0.25 # seconds between two redraws
+rate_time  = 10.0 # seconds, time constant of the moving average rate
+
+# h:mm:ss
+def duration(seconds):
+  seconds = int(seconds)
+  return "%d:%02d:%02d" % (seconds / 3600, (seconds / 60) % 60, seconds % 60)
+
+# update is cheap and can be called for each job done, draw only writes
+# to the terminal every min_period seconds, unless forced to
 class ProgressBar:
     
-  def __init__(self, min_val, max_val):
-    self.min      = float(min_val)
-    self.max      = float(max_val)
-    self.width    = self.max - self.min
-    self.done     = 0
-    self.current  = "done: %3d " % self.done + "%"
-    self.previous = None
-    self.update(0)
+  # nb_workers_fun, if given, returns the number of active workers
+  def __init__(self, min_val, max_val = None, nb_workers_fun = None):
+    self.min            = float(min_val)
+    self.done           = 0
+    self.previous       = None
+    self.nb_workers_fun = nb_workers_fun
+    self.start          = None # time of the first draw
+    self.last_draw      = None # time of the last redraw
+    self.last_done      = 0    # what was done then
+    self.rate           = None # jobs per second, moving average
+    self.finished       = False
+    self.set_max(max_val)
+
+  # max_val is None as long as it is not known,
+  # the count of what is done is shown instead of a percentage
+  def set_max(self, max_val):
+    self.max = max_val
+    if max_val is not None:
+      self.max   = float(max_val)
+      self.width = self.max - self.min
 
   def update(self, new_amount):
-    if self.width > 0.0:
-      new_amount   = float(new_amount)
-      new_amount   = max(new_amount, self.min)
-      new_amount   = min(new_amount, self.max)      
-      self.done    = new_amount
-      delta        = self.done - self.min
-      percent      = int(round((delta / self.width) * 100.0))
-      self.current = "done: %3d " % percent + "%"
-
-  def draw(self):
-    if self.current != self.previous:
-      self.previous = self.current
-      sys.stdout.write(self.current + '\r')
-      if self.done == self.max:
-        sys.stdout.write('\n') # prevent overwriting
-      sys.stdout.flush()
+    self.done = new_amount
+
+  def update_rate(self, now):
+    if self.last_draw is None:
+      self.start     = now
+      self.last_draw = now
+      self.last_done = self.done
+      return
+    elapsed = now - self.last_draw
+    if elapsed <= 0.0:
+      return
+    rate = (self.done - self.last_done) / elapsed
+    # the weight of the new rate grows with the time it was measured on,
+    # early on the rate is the mean since the start
+    weight = max(1.0 - math.exp(-elapsed / rate_time),
+                 elapsed / (now - self.start))
+    if self.rate is None:
+      self.rate = rate
+    else:
+      self.rate = weight * rate + (1.0 - weight) * self.rate
+    self.last_draw = now
+    self.last_done = self.done
+
+  def text(self):
+    if self.max is None:
+      res = "done: %d" % self.done
+    elif self.width > 0.0:
+      done    = min(max(float(self.done), self.min), self.max)
+      percent = int(round(((done - self.min) / self.width) * 100.0))
+      res     = "done: %3d " % percent + "%"
+    else:
+      res = "done: %3d " % 0 + "%"
+    if self.rate is not None:
+      res += " | %.1f jobs/s" % self.rate
+    if self.nb_workers_fun:
+      res += " | %d workers" % self.nb_workers_fun()
+    if (self.rate and self.max is not None and self.done < self.max):
+      res += " | ETA %s" % duration((self.max - self.done) / self.rate)
+    return res
+
+  def draw(self, force = False):
+    if self.finished:
+      return
+    now = time.time()
+    if (not force and self.last_draw is not None and
+        now - self.last_draw < min_period):
+      return
+    self.update_rate(now)
+    current = self.text()
+    if current != self.previous:
+      # blank what is left of a longer previous line
+      padding = ""
+      if self.previous and len(self.previous) > len(current):
+        padding = " " * (len(self.previous) - len(current))
+      self.previous = current
+      sys.stdout.write(current + padding + '\r')
+    if self.max is not None and self.done >= self.max:
+      sys.stdout.write('\n') # prevent overwriting
+      self.finished = True
+    sys.stdout.flush()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+If you use and like our software, please send us a postcard! ^^
+
+Copyright (C) 2009, 2010, Zhang Initiative Research Unit,
+Advance Science Institute, Riken
+2-1 Hirosawa, Wako, Saitama 351-0198, Japan
+---
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+---
+Result records and the files they are written to.
+
+A record is the tuple (command, exit status, start time, end time, stdout,
+stderr), times are seconds since the epoch on the worker. It may end with
+the resources the job used (see UsageLog.py), those are not written here.
+
+The binary format (parallel.py --output-format binary) is the magic line
+below followed by one frame per job:
+  length of the rest of the frame        4 bytes, big endian
+  job id, exit status,                   8 + 4 bytes, big endian
+  start time, end time                   2 * 8 bytes, doubles
+  lengths of command, stdout, stderr     3 * 4 bytes, big endian
+  command, stdout, stderr                raw bytes
+so outputs are written as they are, binary ones included, and a reader
+can skip a record without looking at its contents.
+
+Convert a binary file back to the text format:
+  RecordFile.py results.bin > results.txt
+"""
+
+import struct, sys
+
+magic         = "PAR records 1\n"
+length_format = ">I"
+length_size   = struct.calcsize(length_format)
+header_format = ">QiddIII"
+header_size   = struct.calcsize(header_format)
+
+# prefix each line of data, without looping over lines in Python
+def prefix_lines(prefix, data):
+    if not data:
+        return ""
+    res = prefix + data.replace("\n", "\n" + prefix)
+    if data.endswith("\n"):
+        res = res[:-len(prefix)]
+    return res
+
+# the text format: the command prefixed with 'i:', each line of stdout
+# with 'o:' and each line of stderr with 'e:'
+def to_text(record):
+    (cmd, status, start, end, cmd_stdout, cmd_stderr) = record[:6]
+    return ("i:%s" % cmd +
+            prefix_lines("o:", cmd_stdout) +
+            prefix_lines("e:", cmd_stderr))
+
+class RecordWriter:
+
+    # offset is where output_file is, when appending to a records file
+    def __init__(self, output_file, offset = 0):
+        self.output_file = output_file
+        self.offset      = offset
+        if offset == 0:
+            self.output_file.write(magic)
+            self.offset = len(magic)
+
+    # returns the offset and length of the frame in the file
+    def write(self, job_id, record):
+        (cmd, status, start, end, cmd_stdout, cmd_stderr) = record[:6]
+        length = (header_size + len(cmd) + len(cmd_stdout) +
+                  len(cmd_stderr))
+        self.output_file.write(struct.pack(length_format, length) +
+                               struct.pack(header_format, job_id, status,
+                                           start, end, len(cmd),
+                                           len(cmd_stdout), len(cmd_stderr)))
+        self.output_file.write(cmd)
+        self.output_file.write(cmd_stdout)
+        self.output_file.write(cmd_stderr)
+        res = (self.offset, length_size + length)
+        self.offset += length_size + length
+        return res
+
+# (job id, record) from a frame without its length prefix
+def decode(frame):
+    (job_id, status, start, end, cmd_len, out_len, err_len) = \
+        struct.unpack(header_format, frame[:header_size])
+    i = header_size
+    cmd        = frame[i:i + cmd_len]
+    i += cmd_len
+    cmd_stdout = frame[i:i + out_len]
+    i += out_len
+    cmd_stderr = frame[i:i + err_len]
+    return (job_id, (cmd, status, start, end, cmd_stdout, cmd_stderr))
+
+# (job id, record) of a binary file one after the other, in file order
+def read_records(input_file):
+    if input_file.read(len(magic)) != magic:
+        raise ValueError("not a PAR records file")
+    while True:
+        length = input_file.read(length_size)
+        if not length:
+            break
+        (length,) = struct.unpack(length_format, length)
+        yield decode(input_file.read(length))
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print "usage: %s RECORDS_FILE" % sys.argv[0]
+        sys.exit(1)
+    input_file = open(sys.argv[1], 'rb')
+    for (job_id, record) in read_records(input_file):
+        sys.stdout.write(to_text(record))
+    input_file.close()
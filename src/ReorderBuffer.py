@@ -0,0 +1,90 @@
+"""
+If you use and like our software, please send us a postcard! ^^
+
+Copyright (C) 2009, 2010, Zhang Initiative Research Unit,
+Advance Science Institute, Riken
+2-1 Hirosawa, Wako, Saitama 351-0198, Japan
+---
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+---
+Puts results arriving in any order back in the order of their job ids
+(0, 1, 2, ...).
+Results waiting for a straggler are kept in memory up to max_bytes, the
+next ones are compressed to a temporary file (in $TMPDIR) and read back
+when their turn comes.
+Items must be marshal-able (strings, numbers, None and tuples of them).
+"""
+
+import marshal, tempfile, zlib
+
+from SpillQueue import item_size
+
+class ReorderBuffer:
+
+    def __init__(self, max_bytes, first_id = 0):
+        self.max_bytes  = max_bytes
+        self.next_id    = first_id
+        self.in_memory  = {} # job id -> (item, size)
+        self.nb_bytes   = 0  # in memory
+        self.on_disk    = {} # job id -> (offset, length)
+        self.segment    = None
+        self.write_pos  = 0
+        self.nb_spilled = 0  # since the beginning
+
+    def __len__(self):
+        return len(self.in_memory) + len(self.on_disk)
+
+    def spill(self, job_id, item):
+        if self.segment is None:
+            self.segment = tempfile.TemporaryFile()
+        record = zlib.compress(marshal.dumps(item), 1)
+        self.segment.seek(self.write_pos)
+        self.segment.write(record)
+        self.on_disk[job_id] = (self.write_pos, len(record))
+        self.write_pos  += len(record)
+        self.nb_spilled += 1
+
+    def unspill(self, job_id):
+        (offset, length) = self.on_disk.pop(job_id)
+        self.segment.seek(offset)
+        item = marshal.loads(zlib.decompress(self.segment.read(length)))
+        if not self.on_disk:
+            # nothing left on disk, reuse the file from its beginning
+            self.segment.truncate(0)
+            self.write_pos = 0
+        return item
+
+    # the list of (job id, item) that can be output now, in order
+    def add(self, job_id, item):
+        if job_id != self.next_id:
+            size = item_size(item)
+            if self.in_memory and self.nb_bytes + size > self.max_bytes:
+                self.spill(job_id, item)
+            else:
+                self.in_memory[job_id] = (item, size)
+                self.nb_bytes += size
+            return []
+        res = [(job_id, item)]
+        self.next_id += 1
+        while True:
+            if self.in_memory.has_key(self.next_id):
+                (item, size) = self.in_memory.pop(self.next_id)
+                self.nb_bytes -= size
+            elif self.on_disk.has_key(self.next_id):
+                item = self.unspill(self.next_id)
+            else:
+                break
+            res.append((self.next_id, item))
+            self.next_id += 1
+        return res
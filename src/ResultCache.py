@@ -0,0 +1,173 @@
+"""
+If you use and like our software, please send us a postcard! ^^
+
+Copyright (C) 2009, 2010, Zhang Initiative Research Unit,
+Advance Science Institute, Riken
+2-1 Hirosawa, Wako, Saitama 351-0198, Japan
+---
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+---
+On-disk cache of job records (parallel.py --cache DIR), so that a job which
+was already run successfully is not run again.
+
+The key of a job is the hash of its command and of the contents of the
+files named in its command (the words of the command which are existing
+files, including those declared as {in:PATH}), so that a job is run
+again if one of its input files changed.
+Each record is stored compressed in DIR/xx/KEY. When the cache gets bigger
+than its maximum size, the least recently used records are removed.
+"""
+
+import marshal, os, thread, time, zlib
+
+try:
+    from hashlib import md5
+except ImportError: # python 2.4
+    from md5 import new as md5
+
+from InputCache import declared_input
+
+# characters around a file name in a command
+separators = "\"'`;|&<>()"
+
+class ResultCache:
+
+    def __init__(self, directory, max_bytes):
+        self.directory   = directory
+        self.max_bytes   = max_bytes
+        self.lock        = thread.allocate_lock()
+        self.entries     = {} # key -> [size, last use]
+        self.nb_bytes    = 0
+        self.file_hashes = {} # file name -> (size, mtime, hash)
+        self.pending     = {} # job id -> key, for jobs being run
+        self.nb_hits     = 0
+        self.nb_misses   = 0
+        self.nb_evicted  = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for sub_dir in os.listdir(directory):
+            sub_dir = os.path.join(directory, sub_dir)
+            if not os.path.isdir(sub_dir):
+                continue
+            for key in os.listdir(sub_dir):
+                stat = os.stat(os.path.join(sub_dir, key))
+                self.entries[key] = [stat.st_size, stat.st_mtime]
+                self.nb_bytes += stat.st_size
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def file_hash(self, file_name):
+        stat = os.stat(file_name)
+        known = self.file_hashes.get(file_name)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            return known[2]
+        h = md5()
+        f = open(file_name, 'rb')
+        data = f.read(1024 * 1024)
+        while data:
+            h.update(data)
+            data = f.read(1024 * 1024)
+        f.close()
+        res = h.hexdigest()
+        self.file_hashes[file_name] = (stat.st_size, stat.st_mtime, res)
+        return res
+
+    # names of the existing files the command mentions
+    def input_files(self, cmd):
+        res = []
+        for word in declared_input.sub(r" \1 ", cmd).split():
+            for c in separators:
+                word = word.replace(c, " ")
+            for name in word.replace("=", " ").split():
+                if os.path.isfile(name) and not name in res:
+                    res.append(name)
+        res.sort()
+        return res
+
+    def key(self, cmd):
+        h = md5(cmd.rstrip("\n"))
+        for name in self.input_files(cmd):
+            h.update("\0%s\0%s" % (name, self.file_hash(name)))
+        return h.hexdigest()
+
+    # the record of a previous run of this job, None if there is none;
+    # in that case the job's result is expected later by store
+    def lookup(self, job_id, cmd):
+        try:
+            key = self.key(cmd)
+        except EnvironmentError: # an input file vanished, don't cache
+            return None
+        res = None
+        self.lock.acquire()
+        if self.entries.has_key(key):
+            try:
+                f = open(self.path(key), 'rb')
+                res = marshal.loads(zlib.decompress(f.read()))
+                f.close()
+                # the modification time is the last use when loading
+                os.utime(self.path(key), None)
+                self.entries[key][1] = time.time()
+                self.nb_hits += 1
+            except EnvironmentError: # removed behind our back
+                self.nb_bytes -= self.entries.pop(key)[0]
+        if res is None:
+            self.nb_misses += 1
+            self.pending[job_id] = key
+        self.lock.release()
+        return res
+
+    # record the result of a job which was not in the cache,
+    # only successful jobs are kept, without the resources they used
+    def store(self, job_id, record):
+        self.lock.acquire()
+        key = self.pending.pop(job_id, None)
+        if key is not None and record[1] == 0:
+            data = zlib.compress(marshal.dumps(record[:6]), 1)
+            if not os.path.isdir(os.path.dirname(self.path(key))):
+                os.mkdir(os.path.dirname(self.path(key)))
+            f = open(self.path(key), 'wb')
+            f.write(data)
+            f.close()
+            if self.entries.has_key(key):
+                self.nb_bytes -= self.entries[key][0]
+            self.entries[key] = [len(data), time.time()]
+            self.nb_bytes += len(data)
+            self.evict()
+        self.lock.release()
+
+    # lock must be held
+    def evict(self):
+        if self.nb_bytes <= self.max_bytes:
+            return
+        by_use = [(use, key) for (key, (size, use)) in self.entries.items()]
+        by_use.sort()
+        for (use, key) in by_use:
+            if self.nb_bytes <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+            self.nb_bytes -= self.entries.pop(key)[0]
+            self.nb_evicted += 1
+
+    def report(self):
+        hit_rate = 0.0
+        if self.nb_hits + self.nb_misses > 0:
+            hit_rate = (100.0 * self.nb_hits) / (self.nb_hits + self.nb_misses)
+        return ("%d hits, %d misses (%.1f%% hit rate), %d evicted, "
+                "%.1f MB used") % (self.nb_hits, self.nb_misses, hit_rate,
+                                   self.nb_evicted,
+                                   self.nb_bytes / (1024.0 * 1024.0))
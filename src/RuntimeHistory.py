@@ -0,0 +1,131 @@
+"""
+If you use and like our software, please send us a postcard! ^^
+
+Copyright (C) 2009, 2010, Zhang Initiative Research Unit,
+Advance Science Institute, Riken
+2-1 Hirosawa, Wako, Saitama 351-0198, Japan
+---
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+---
+Runtimes of the commands of previous runs (parallel.py --history FILE),
+and the queue which gives the longest jobs first (parallel.py --order lpt).
+
+The runtime of a command is predicted from the previous runs of the same
+command, else from the previous runs of commands with the same template
+(the command with its numbers replaced by '#', e.g. 'blast -i seq_#.fa'),
+else it is the mean of the templates known at the start of the run.
+Each runtime is a moving average of the wall times, so that it follows
+the recent runs.
+
+FILE has one line per command and per template:
+  kind ('c' or 't'), hash of the command or template, runs, seconds
+it is rewritten at the end of each run.
+"""
+
+import heapq, os, re
+
+from Queue   import Queue
+from Journal import hex_hash
+
+weight = 0.3 # of the last run in the moving average
+
+digits = re.compile(r"\d+")
+
+def command_template(cmd):
+    return digits.sub("#", cmd.strip())
+
+class RuntimeHistory:
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.runtimes  = {} # (kind, hash) -> [runs, seconds]
+        if os.path.exists(file_name):
+            history_file = open(file_name, 'r')
+            for line in history_file:
+                fields = line.split()
+                if len(fields) != 4 or line.startswith("#"):
+                    continue
+                self.runtimes[(fields[0], fields[1])] = [int(fields[2]),
+                                                         float(fields[3])]
+            history_file.close()
+        # for commands never seen, the mean of the known templates
+        self.default = 0.0
+        templates = [seconds for ((kind, h), (runs, seconds))
+                     in self.runtimes.items() if kind == "t"]
+        if templates:
+            self.default = sum(templates) / len(templates)
+
+    def keys(self, cmd):
+        return [("c", hex_hash(cmd)), ("t", hex_hash(command_template(cmd)))]
+
+    def add(self, cmd, seconds):
+        for key in self.keys(cmd):
+            known = self.runtimes.get(key)
+            if known is None:
+                self.runtimes[key] = [1, seconds]
+            else:
+                known[0] += 1
+                known[1] = weight * seconds + (1.0 - weight) * known[1]
+
+    def predict(self, cmd):
+        for key in self.keys(cmd):
+            if self.runtimes.has_key(key):
+                return self.runtimes[key][1]
+        return self.default
+
+    # written to a new file first, so that an interrupted save
+    # doesn't lose the history
+    def save(self):
+        tmp_name = self.file_name + ".tmp"
+        history_file = open(tmp_name, 'w')
+        history_file.write("# kind hash runs seconds\n")
+        for ((kind, h), (runs, seconds)) in self.runtimes.items():
+            history_file.write("%s %s %d %.3f\n" % (kind, h, runs, seconds))
+        history_file.close()
+        os.rename(tmp_name, self.file_name)
+
+# the jobs queue of the master, (job id, command) pairs come out
+# by decreasing predicted runtime and "END" comes out last; nothing comes
+# out before the whole input was read or the queue is full, so that the
+# longest jobs are not missed because they came late
+class LongestFirstQueue(Queue):
+
+    def __init__(self, history, maxsize = 0):
+        self.history = history
+        Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.maxsize = maxsize
+        self.queue   = [] # heap of (is END, -runtime, job id, job)
+        self.sealed  = False
+
+    def _qsize(self):
+        if self.sealed or (self.maxsize > 0 and
+                           len(self.queue) >= self.maxsize):
+            return len(self.queue)
+        return 0
+
+    def _empty(self): # python 2.4
+        return self._qsize() == 0
+
+    def _put(self, job):
+        if job == "END":
+            self.sealed = True
+            heapq.heappush(self.queue, (1, 0, 0, job))
+        else:
+            heapq.heappush(self.queue, (0, -self.history.predict(job[1]),
+                                        job[0], job))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[3]
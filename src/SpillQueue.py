@@ -0,0 +1,129 @@
+"""
+If you use and like our software, please send us a postcard! ^^
+
+Copyright (C) 2009, 2010, Zhang Initiative Research Unit,
+Advance Science Institute, Riken
+2-1 Hirosawa, Wako, Saitama 351-0198, Japan
+---
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+---
+A FIFO queue which keeps at most max_bytes of items in memory, the other
+ones are compressed and written to a temporary file (in $TMPDIR), then
+read back in order.
+Items must be marshal-able (strings, numbers, None and tuples of them).
+"""
+
+import marshal, struct, tempfile, time, zlib
+
+from collections import deque
+from Queue       import Empty
+from threading   import Condition
+
+header_format = ">I" # length of the compressed record which follows
+header_size   = struct.calcsize(header_format)
+
+# approximate memory used by an item
+def item_size(item):
+    if isinstance(item, str):
+        return len(item)
+    if isinstance(item, tuple) or isinstance(item, list):
+        res = 0
+        for x in item:
+            res += item_size(x)
+        return res
+    return 8
+
+class SpillQueue:
+
+    def __init__(self, max_bytes):
+        self.max_bytes  = max_bytes
+        self.items      = deque()
+        self.nb_bytes   = 0 # in memory
+        self.cond       = Condition()
+        self.segment    = None
+        self.read_pos   = 0
+        self.write_pos  = 0
+        self.nb_on_disk = 0
+        self.nb_spilled = 0 # since the beginning
+
+    def qsize(self):
+        self.cond.acquire()
+        res = len(self.items) + self.nb_on_disk
+        self.cond.release()
+        return res
+
+    def spill(self, item):
+        if self.segment is None:
+            self.segment = tempfile.TemporaryFile()
+        record = zlib.compress(marshal.dumps(item), 1)
+        self.segment.seek(self.write_pos)
+        self.segment.write(struct.pack(header_format, len(record)))
+        self.segment.write(record)
+        self.write_pos  += header_size + len(record)
+        self.nb_on_disk += 1
+        self.nb_spilled += 1
+
+    def unspill(self):
+        self.segment.seek(self.read_pos)
+        (length,) = struct.unpack(header_format,
+                                  self.segment.read(header_size))
+        item = marshal.loads(zlib.decompress(self.segment.read(length)))
+        self.read_pos   += header_size + length
+        self.nb_on_disk -= 1
+        if self.nb_on_disk == 0:
+            # everything was read back, reuse the file from its beginning
+            self.segment.truncate(0)
+            self.read_pos  = 0
+            self.write_pos = 0
+        return item
+
+    def put(self, item):
+        size = item_size(item)
+        self.cond.acquire()
+        # once something is on disk, everything else goes there too
+        # until it is read back, else the order would not be kept
+        if (self.nb_on_disk > 0 or
+            (self.items and self.nb_bytes + size > self.max_bytes)):
+            self.spill(item)
+        else:
+            self.items.append((item, size))
+            self.nb_bytes += size
+        self.cond.notify()
+        self.cond.release()
+
+    # same as Queue.get: raises Empty if there is no item after timeout
+    # seconds, or right away if not block
+    def get(self, block = True, timeout = None):
+        self.cond.acquire()
+        try:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self.items and self.nb_on_disk == 0:
+                if not block:
+                    raise Empty
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    self.cond.wait(remaining)
+            if self.items:
+                (item, size) = self.items.popleft()
+                self.nb_bytes -= size
+            else:
+                item = self.unspill()
+        finally:
+            self.cond.release()
+        return item
@@ -0,0 +1,110 @@
+"""
+If you use and like our software, please send us a postcard! ^^
+
+Copyright (C) 2009, 2010, Zhang Initiative Research Unit,
+Advance Science Institute, Riken
+2-1 Hirosawa, Wako, Saitama 351-0198, Japan
+---
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+---
+Resources used by each job (parallel.py --rusage FILE).
+
+Workers measure them when they reap a job and send them with its output,
+as the last item of its record: (user CPU time, system CPU time,
+maximum resident set size in KB, blocks read, blocks written, resident
+set size in KB of the worker's process when it started the job).
+One tab separated line per job is written to FILE:
+  job id, exit status, wall time, user time, system time, max RSS,
+  blocks read, blocks written, worker RSS, command
+with '-' for what is unknown, e.g. for jobs taken from the cache.
+
+A job is forked from the worker's process before it runs its command,
+and the kernel counts the pages it shares with that process until then
+in its max RSS: the max RSS of a job is the biggest of its own peak and
+the worker RSS. When it is not above the worker RSS, the job's own peak
+is unknown, so the job is left out of the heaviest commands, which are
+listed with the slowest ones at the end of the run.
+"""
+
+import heapq
+
+nb_shown = 5 # commands in each list of the summary
+
+header = ("# job\tstatus\twall_s\tuser_s\tsys_s\tmaxrss_kb\tblocks_in\t"
+          "blocks_out\tworker_rss_kb\tcommand\n")
+
+# the resources used, from a record, None if unknown
+def record_usage(record):
+    if len(record) > 6:
+        return record[6]
+    return None
+
+class UsageLog:
+
+    # append to usage_file when resuming a run
+    def __init__(self, usage_file, append = False):
+        self.usage_file = usage_file
+        self.slowest    = [] # heaps of (value, command) of the biggest
+        self.most_cpu   = []
+        self.biggest    = []
+        usage_file.seek(0, 2)
+        if not append or usage_file.tell() == 0:
+            self.usage_file.write(header)
+
+    def keep(self, heap, value, cmd):
+        heapq.heappush(heap, (value, cmd))
+        if len(heap) > nb_shown:
+            heapq.heappop(heap)
+
+    def add(self, job_id, record):
+        cmd   = record[0].rstrip("\n")
+        wall  = record[3] - record[2]
+        usage = record_usage(record)
+        if usage is None:
+            fields = ["-"] * 6
+        else:
+            (user, system, max_rss, blocks_in, blocks_out) = usage[:5]
+            fields = ["%.3f" % user, "%.3f" % system, "%d" % max_rss,
+                      "%d" % blocks_in, "%d" % blocks_out, "-"]
+            worker_rss = 0 # unknown from older workers
+            if len(usage) > 5:
+                worker_rss = usage[5]
+                fields[5]  = "%d" % worker_rss
+            self.keep(self.most_cpu, user + system, cmd)
+            if max_rss > worker_rss:
+                self.keep(self.biggest, max_rss, cmd)
+        self.keep(self.slowest, wall, cmd)
+        self.usage_file.write("%d\t%d\t%.3f\t%s\t%s\n" %
+                              (job_id, record[1], wall, "\t".join(fields),
+                               cmd))
+
+    def top(self, title, heap, unit_format):
+        res = title + ":\n"
+        entries = heap[:]
+        entries.sort()
+        entries.reverse()
+        for (value, cmd) in entries:
+            res += "  " + unit_format % value + "  " + cmd + "\n"
+        return res
+
+    def summary(self):
+        res = self.top("slowest jobs", self.slowest, "%10.1f s")
+        if self.most_cpu:
+            res += self.top("most CPU", self.most_cpu, "%10.1f s")
+            if self.biggest:
+                res += self.top("most memory", self.biggest, "%10d KB")
+        return res
+
+    def close(self):
+        self.usage_file.close()
@@ -0,0 +1,90 @@
+"""
+If you use and like our software, please send us a postcard! ^^
+
+Copyright (C) 2009, 2010, Zhang Initiative Research Unit,
+Advance Science Institute, Riken
+2-1 Hirosawa, Wako, Saitama 351-0198, Japan
+---
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+---
+Compression of what travels between clients and the master.
+A packed payload starts with one byte telling how the rest is encoded:
+'z' for zlib, 'r' for raw. Small payloads and payloads which don't
+compress well are sent raw.
+"""
+
+import thread, time, zlib
+
+min_size    = 512       # smaller payloads are not worth compressing
+sample_size = 4096      # big payloads are first tried on this much
+max_ratio   = 0.9       # compressed/raw size beyond which we send raw
+
+class WireCodec:
+
+    def __init__(self, enabled, level = 1):
+        self.enabled     = enabled
+        self.level       = level
+        self.lock        = thread.allocate_lock()
+        self.packed_raw  = 0 # bytes given to pack
+        self.packed_wire = 0 # bytes pack returned
+        self.pack_time   = 0.0
+        self.unpack_raw  = 0 # bytes unpack returned
+        self.unpack_wire = 0 # bytes given to unpack
+        self.unpack_time = 0.0
+
+    def compressible(self, data):
+        if len(data) <= sample_size:
+            return True
+        sample = data[:sample_size]
+        return len(zlib.compress(sample, self.level)) < max_ratio * len(sample)
+
+    def pack(self, data):
+        start = time.time()
+        res   = None
+        if self.enabled and len(data) >= min_size and self.compressible(data):
+            compressed = zlib.compress(data, self.level)
+            if len(compressed) < max_ratio * len(data):
+                res = "z" + compressed
+        if res is None:
+            res = "r" + data
+        self.lock.acquire()
+        self.packed_raw  += len(data)
+        self.packed_wire += len(res)
+        self.pack_time   += time.time() - start
+        self.lock.release()
+        return res
+
+    def unpack(self, packed):
+        start = time.time()
+        if packed[0] == "z":
+            res = zlib.decompress(packed[1:])
+        else:
+            res = packed[1:]
+        self.lock.acquire()
+        self.unpack_raw  += len(res)
+        self.unpack_wire += len(packed)
+        self.unpack_time += time.time() - start
+        self.lock.release()
+        return res
+
+    def report(self):
+        mb = 1024.0 * 1024.0
+        return (("sent %.1f MB as %.1f MB (saved %.1f MB, %.2f s "
+                 "compressing), received %.1f MB as %.1f MB (saved %.1f MB, "
+                 "%.2f s decompressing)") %
+                (self.packed_raw / mb, self.packed_wire / mb,
+                 (self.packed_raw - self.packed_wire) / mb, self.pack_time,
+                 self.unpack_raw / mb, self.unpack_wire / mb,
+                 (self.unpack_raw - self.unpack_wire) / mb,
+                 self.unpack_time))
@@ -30,49 +30,754 @@ warning: keep this script compatible with python 2.4 so that we can run it
          on old systems too
 """
 
-import commands, os, socket, subprocess, sys, tempfile, time, thread
+import commands, errno, fcntl, heapq, marshal, math, os, re, select, socket
+import subprocess, sys, tempfile, thread, time
 
 import rfoo                                                           # CC
 
-from optparse    import OptionParser
-from threading   import Thread
+from collections    import deque
+from optparse       import OptionParser
+from threading      import Condition, Event, Thread, local
 
-from Queue       import Queue, Empty
-from ProgressBar import ProgressBar
-from StringIO    import StringIO
-from subprocess  import Popen
+from Queue          import Queue, Empty
+from AutoScaler     import AutoScaler
+from DataStage      import StageServer, link_all, stage_from
+from DataStage      import default_port as default_stage_port
+from InputCache     import InputCache, declared_input
+from Journal        import Journal, hex_hash, read_journal
+from LoadProbe      import LoadProbe, signal_number
+from LogIndex       import IndexWriter, index_file_name
+from Metrics        import Metrics, MetricsServer
+from ProgressBar    import ProgressBar
+from RecordFile     import RecordWriter, to_text
+from ResultCache    import ResultCache
+from ReorderBuffer  import ReorderBuffer
+from RuntimeHistory import LongestFirstQueue, RuntimeHistory
+from SpillQueue     import SpillQueue
+from UsageLog       import UsageLog
+from WireCodec      import WireCodec
+from subprocess     import Popen, PIPE
 
-class Master( rfoo.BaseHandler ):                                     # CC
+# lease size policies: given the number of jobs a worker asked for,
+# the number of jobs still queued and the number of active workers,
+# return how many jobs to lease to this worker
 
-    def __init__(self, commands_q, results_q, begin_cmd = "", end_cmd = ""):
+# exactly what the worker asked for (one at a time by default)
+def fixed_lease_size(n, nb_queued, nb_workers):
+    return n
+
+# guided self-scheduling: 1/P of what remains,
+# big leases at the beginning and small ones at the end of the run
+def guided_lease_size(n, nb_queued, nb_workers):
+    size = int(math.ceil(float(nb_queued) / max(1, nb_workers)))
+    return max(1, min(n, size))
+
+# factoring: 1/(2P) of what remains, more conservative than guided
+# when job durations vary a lot
+def factoring_lease_size(n, nb_queued, nb_workers):
+    size = int(math.ceil(float(nb_queued) / (2 * max(1, nb_workers))))
+    return max(1, min(n, size))
+
+lease_size_policies = { "fixed"     : fixed_lease_size,
+                        "guided"    : guided_lease_size,
+                        "factoring" : factoring_lease_size }
+
+class Master:
+
+    def __init__(self, commands_q, results_q, begin_cmd = "", end_cmd = "",
+                 schedule = "fixed", lease_time = 0, compress = False,
+                 cache = None, metrics = None):
         self.jobs_queue     = commands_q
         self.results_queue  = results_q
         self.lock           = thread.allocate_lock()
         self.no_more_jobs   = False
         self.begin_command  = begin_cmd
         self.end_command    = end_cmd
+        self.lease_size     = lease_size_policies[schedule]
+        self.nb_workers     = 0
+        # worker failure management: each time a job is sent to a worker it
+        # gets a new lease id, a job whose last lease expires is sent again
+        # and the first result received for any of its leases completes it
+        self.lease_time     = lease_time # seconds, 0 means leases never expire
+        self.leases_lock    = thread.allocate_lock()
+        self.next_job_id    = 0
+        self.next_lease_id  = 0
+        self.leases         = {}      # lease id -> [job id, deadline]
+        self.in_flight      = {}      # job id -> (cmd, lease ids)
+        self.deadlines      = []      # heap of (deadline, lease id)
+        self.redo           = deque() # ids of jobs to send again
+        self.codec          = WireCodec(compress)
+        self.clients_cond   = Condition()
+        self.nb_connections = 0       # of clients, server side
+        self.cache          = cache # of results from previous runs
+        self.stage_port     = 0     # of our stage server, 0 if none
+        self.metrics        = metrics
+        if metrics:
+            # gauges are read without our locks
+            metrics.gauge("par_jobs_queued", "jobs read and not leased yet",
+                          self.jobs_queue.qsize)
+            metrics.gauge("par_jobs_in_flight", "jobs leased and not done",
+                          lambda: len(self.in_flight))
+            metrics.gauge("par_jobs_redo", "jobs to send again",
+                          lambda: len(self.redo))
+            metrics.gauge("par_results_queued", "results not written yet",
+                          self.results_queue.qsize)
+            metrics.gauge("par_workers", "workers asking for jobs",
+                          lambda: self.nb_workers)
+            metrics.gauge("par_clients_connected",
+                          "connections open from clients, one per thread "
+                          "of a client talking to us",
+                          lambda: self.nb_connections)
+            self.dispatch_time = metrics.histogram(
+                "par_dispatch_seconds", "time to answer get_work_batch",
+                [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5])
+            self.wall_time     = metrics.histogram(
+                "par_job_wall_seconds", "wall time of the jobs done",
+                [0.01, 0.1, 1, 10, 60, 600, 3600])
+            self.result_bytes  = metrics.counter(
+                "par_result_bytes_total", "stdout and stderr bytes received")
+            self.nb_done       = metrics.counter(
+                "par_jobs_done_total", "jobs done")
+            # per connection of a client, i.e. per worker unless it
+            # prefetches or is a relay
+            self.client_done   = metrics.labeled_counter(
+                "par_client_jobs_done_total",
+                "jobs done by each client connection, local for our workers",
+                "client")
 
-    def get_work(self, previous_result = None):
-        if previous_result:
-            self.results_queue.put(previous_result)
-        res = None
-        self.lock.acquire()
-        if self.no_more_jobs:
-            res = ""
+    # leases_lock must be held
+    def lease(self, job_id, cmd):
+        lease_id = self.next_lease_id
+        self.next_lease_id += 1
+        deadline = None
+        if self.lease_time > 0:
+            deadline = time.time() + self.lease_time
+            heapq.heappush(self.deadlines, (deadline, lease_id))
+        self.leases[lease_id] = [job_id, deadline]
+        if self.in_flight.has_key(job_id):
+            self.in_flight[job_id][1].append(lease_id)
         else:
-            res = self.jobs_queue.get(True)
-            if res == "END":
-                self.no_more_jobs = True
-                res = ""
+            self.in_flight[job_id] = (cmd, [lease_id])
+        return (lease_id, cmd)
+
+    # leases_lock must be held
+    def expire_leases(self):
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            (deadline, lease_id) = heapq.heappop(self.deadlines)
+            lease = self.leases.get(lease_id)
+            if lease is None or lease[1] != deadline:
+                continue # completed or renewed since
+            job_id = lease[0]
+            if self.in_flight[job_id][1][-1] == lease_id:
+                # the job was not sent again since this lease
+                self.redo.append(job_id)
+                sys.stderr.write("warning: lease %d expired, job %d will be "
+                                 "sent again\n" % (lease_id, job_id))
+
+    # lease up to n jobs at once and accept the results of the previous
+    # batch in the same call, this saves one round trip per job
+    # jobs are (lease id, command) pairs, results are (lease id, output) ones
+    # with output what JobRunner.run returns
+    # an empty list means there are no more jobs, None means there is
+    # nothing to do right now but some leases may still expire
+    # client is the address of the connection of a remote worker
+    def get_work_batch(self, n, previous_results = None, client = "local"):
+        start = time.time()
+        if previous_results:
+            self.put_results(previous_results, client)
+        res  = []
+        jobs = []
+        self.lock.acquire()
+        n = self.lease_size(n, self.jobs_queue.qsize() + len(self.redo),
+                            self.nb_workers)
+        while True:
+            # jobs from expired leases go first
+            self.leases_lock.acquire()
+            self.expire_leases()
+            while len(res) < n and self.redo:
+                job_id = self.redo.popleft()
+                if self.in_flight.has_key(job_id): # else completed meanwhile
+                    res.append(self.lease(job_id, self.in_flight[job_id][0]))
+            self.leases_lock.release()
+            # only wait for the first job, a batch is never held back
+            # until it is full; while the input is stalled, leases
+            # expiring meanwhile are looked at every second
+            block = not res
+            try:
+                while len(res) + len(jobs) < n and not self.no_more_jobs:
+                    job = self.jobs_queue.get(block, 1.0)
+                    block = False
+                    if job == "END":
+                        self.no_more_jobs = True
+                    else:
+                        jobs.append(job)
+            except Empty:
+                if block:
+                    continue
+            break
+        self.leases_lock.acquire()
+        for (job_id, cmd) in jobs:
+            res.append(self.lease(job_id, cmd))
+        if not res:
+            if self.lease_time > 0 and self.in_flight:
+                res = None
+            else:
+                # this worker is leaving
+                self.nb_workers -= 1
+        self.leases_lock.release()
         self.lock.release()
+        if self.metrics:
+            self.dispatch_time.observe(time.time() - start)
         return res
 
+    # send results without asking for more work
+    def put_results(self, results, client = "local"):
+        done = []
+        self.leases_lock.acquire()
+        for (lease_id, output) in results:
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                sys.stderr.write("warning: discarding result of unknown or "
+                                 "already completed lease %d\n" % lease_id)
+                continue
+            (cmd, lease_ids) = self.in_flight.pop(lease[0])
+            for l in lease_ids:
+                del self.leases[l]
+            done.append((lease[0], (cmd,) + tuple(output)))
+        self.leases_lock.release()
+        for result in done:
+            self.results_queue.put(result) # (job id, record)
+        if self.metrics:
+            for (job_id, record) in done:
+                self.wall_time.observe(record[3] - record[2])
+                self.result_bytes.add(len(record[4]) + len(record[5]))
+            self.nb_done.add(len(done))
+            self.client_done.add(client, len(done))
+
+    # called periodically by workers for the jobs they are running
+    def renew_leases(self, lease_ids):
+        if self.lease_time <= 0:
+            return
+        deadline = time.time() + self.lease_time
+        self.leases_lock.acquire()
+        for lease_id in lease_ids:
+            lease = self.leases.get(lease_id)
+            if lease is not None:
+                lease[1] = deadline
+                heapq.heappush(self.deadlines, (deadline, lease_id))
+        self.leases_lock.release()
+
+    def get_lease_time(self):
+        return self.lease_time
+
+    # the codec to use with a client supporting codecs, "" means none
+    def negotiate_compression(self, codecs):
+        if self.codec.enabled and "zlib" in codecs:
+            return "zlib"
+        return ""
+
+    # where clients fetch the staged files, 0 when nothing is staged
+    def get_stage_port(self):
+        return self.stage_port
+
+    # same as get_work_batch and put_results for clients which negotiated
+    # compression, results and jobs travel as packed marshal dumps
+    def get_work_batch_packed(self, n, packed_results, client = "local"):
+        results = marshal.loads(self.codec.unpack(packed_results))
+        works   = self.get_work_batch(n, results, client)
+        return self.codec.pack(marshal.dumps(works))
+
+    def put_results_packed(self, packed_results, client = "local"):
+        self.put_results(marshal.loads(self.codec.unpack(packed_results)),
+                         client)
+
+    # returns the job id of cmd
     def add_job(self, cmd):
-        self.jobs_queue.put(cmd)
+        if cmd == "END":
+            self.jobs_queue.put(cmd)
+            return None
+        job_id = self.next_job_id
+        self.next_job_id += 1
+        record = None
+        if self.cache:
+            record = self.cache.lookup(job_id, cmd)
+        if record is None:
+            self.jobs_queue.put((job_id, cmd))
+        else: # no need to run it
+            self.results_queue.put((job_id, record))
+        return job_id
 
+    # the next command will not be run, but job ids must stay line numbers
+    def skip_job(self):
+        self.next_job_id += 1
+
+    # every worker calls this once when it starts
     def get_begin_end_commands(self):
+        self.lock.acquire()
+        self.nb_workers += 1
+        self.lock.release()
         return (self.begin_command, self.end_command)
 
+    def client_connected(self):
+        self.clients_cond.acquire()
+        self.nb_connections += 1
+        self.clients_cond.release()
+
+    def client_gone(self):
+        self.clients_cond.acquire()
+        self.nb_connections -= 1
+        self.clients_cond.notifyAll()
+        self.clients_cond.release()
+
+    # at the end of a run, gives clients some time to get their last
+    # answers and disconnect before the server exits
+    def wait_for_clients(self, timeout):
+        deadline = time.time() + timeout
+        self.clients_cond.acquire()
+        while self.nb_connections > 0 and time.time() < deadline:
+            self.clients_cond.wait(deadline - time.time())
+        self.clients_cond.release()
+
+# what a client gets when its server is gone, e.g. because it had no
+# more jobs to send
+connection_closed = (rfoo.EofError, socket.error)                    # CC
+
+# rfoo makes one handler per client connection, they all talk to the
+# same master
+class MasterHandler( rfoo.BaseHandler ):                              # CC
+
+    def __init__(self, addr, master):
+        rfoo.BaseHandler.__init__(self, addr, master)
+        self.master = master
+        self.client = "%s:%d" % addr
+        master.client_connected()
+
+    # called by rfoo when the client disconnects
+    def _close(self):
+        rfoo.BaseHandler._close(self)
+        self.master.client_gone()
+
+    def get_work_batch(self, n, previous_results = None):
+        return self.master.get_work_batch(n, previous_results, self.client)
+
+    def put_results(self, results):
+        self.master.put_results(results, self.client)
+
+    def renew_leases(self, lease_ids):
+        self.master.renew_leases(lease_ids)
+
+    def get_lease_time(self):
+        return self.master.get_lease_time()
+
+    def negotiate_compression(self, codecs):
+        return self.master.negotiate_compression(codecs)
+
+    def get_stage_port(self):
+        return self.master.get_stage_port()
+
+    def get_work_batch_packed(self, n, packed_results):
+        return self.master.get_work_batch_packed(n, packed_results,
+                                                 self.client)
+
+    def put_results_packed(self, packed_results):
+        self.master.put_results_packed(packed_results, self.client)
+
+    def get_begin_end_commands(self):
+        return self.master.get_begin_end_commands()
+
+# stands in for the master of a server, an rfoo connection carries one
+# call at a time so each thread gets its own
+class RemoteMaster:
+
+    def __init__(self, host, port):
+        self.host        = host
+        self.port        = port
+        self.local       = local()
+        self.lock        = thread.allocate_lock()
+        self.connections = []
+
+    def proxy(self):
+        if not hasattr(self.local, "proxy"):
+            connection = rfoo.connect(host = self.host, port = self.port)
+            self.lock.acquire()
+            self.connections.append(connection)
+            self.lock.release()
+            self.local.proxy = rfoo.Proxy(connection)
+        return self.local.proxy
+
+    def get_work_batch(self, n, previous_results = None):
+        return self.proxy().get_work_batch(n, previous_results)
+
+    def put_results(self, results):
+        self.proxy().put_results(results)
+
+    def renew_leases(self, lease_ids):
+        self.proxy().renew_leases(lease_ids)
+
+    def get_lease_time(self):
+        return self.proxy().get_lease_time()
+
+    def negotiate_compression(self, codecs):
+        return self.proxy().negotiate_compression(codecs)
+
+    def get_stage_port(self):
+        return self.proxy().get_stage_port()
+
+    def get_work_batch_packed(self, n, packed_results):
+        return self.proxy().get_work_batch_packed(n, packed_results)
+
+    def put_results_packed(self, packed_results):
+        self.proxy().put_results_packed(packed_results)
+
+    def get_begin_end_commands(self):
+        return self.proxy().get_begin_end_commands()
+
+    def close(self):
+        self.lock.acquire()
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.lock.release()
+
+# stands in for a remote master with which compression was negotiated
+class PackedMaster:
+
+    def __init__(self, master):
+        self.master = master
+        self.codec  = WireCodec(True)
+
+    def get_work_batch(self, n, previous_results = None):
+        if previous_results is None:
+            previous_results = []
+        packed = self.codec.pack(marshal.dumps(previous_results))
+        works  = self.master.get_work_batch_packed(n, packed)
+        return marshal.loads(self.codec.unpack(works))
+
+    def put_results(self, results):
+        self.master.put_results_packed(self.codec.pack(marshal.dumps(results)))
+
+    def renew_leases(self, lease_ids):
+        self.master.renew_leases(lease_ids)
+
+    def get_lease_time(self):
+        return self.master.get_lease_time()
+
+    def get_begin_end_commands(self):
+        return self.master.get_begin_end_commands()
+
+    def close(self):
+        sys.stderr.write("compression: %s\n" % self.codec.report())
+        self.master.close()
+
+# stands in for the master and renews the leases of the jobs this process
+# holds, so that they don't expire while the jobs are still running
+class LeaseKeeper:
+
+    def __init__(self, master, lease_time):
+        self.master = master
+        self.period = lease_time / 3.0
+        self.held   = {} # lease ids
+        self.lock   = thread.allocate_lock()
+        self.closed = False
+        renewer = Thread(target = self.renew)
+        renewer.setDaemon(True)
+        renewer.start()
+
+    def forget(self, results):
+        if results:
+            self.lock.acquire()
+            for (lease_id, output) in results:
+                self.held.pop(lease_id, None)
+            self.lock.release()
+
+    def renew(self):
+        while not self.closed:
+            time.sleep(self.period)
+            self.lock.acquire()
+            lease_ids = self.held.keys()
+            self.lock.release()
+            if lease_ids:
+                try:
+                    self.master.renew_leases(lease_ids)
+                except:
+                    print "Exception :", sys.exc_type, sys.exc_value
+                    print "warning: could not renew leases"
+
+    def get_work_batch(self, n, previous_results = None):
+        self.forget(previous_results)
+        works = self.master.get_work_batch(n, previous_results)
+        if works:
+            self.lock.acquire()
+            for (lease_id, cmd) in works:
+                self.held[lease_id] = True
+            self.lock.release()
+        return works
+
+    def put_results(self, results):
+        self.forget(results)
+        self.master.put_results(results)
+
+    def get_begin_end_commands(self):
+        return self.master.get_begin_end_commands()
+
+    def close(self):
+        self.closed = True
+        self.master.close()
+
+# client-side stand-in for the master: keeps up to nb_prefetch jobs
+# leased in advance so that a local worker can start its next job as soon
+# as the previous one exits, talking to the real master is done by a
+# feeder thread, so results upload overlaps with job execution
+class Prefetcher:
+
+    def __init__(self, master, nb_prefetch):
+        self.master       = master
+        self.nb_prefetch  = nb_prefetch
+        self.jobs_queue   = Queue()
+        self.results      = []
+        self.lock         = thread.allocate_lock()
+        self.wakeup       = Event()
+        self.no_more_jobs = False
+        self.retry_later  = False # the master has nothing for now
+        self.closed       = False
+        self.begin_end    = master.get_begin_end_commands()
+        self.feeder       = Thread(target = self.feed)
+        self.feeder.setDaemon(True)
+        self.wakeup.set() # fill the buffer right now
+        self.feeder.start()
+
+    def take_results(self):
+        self.lock.acquire()
+        res          = self.results
+        self.results = []
+        self.lock.release()
+        return res
+
+    def feed(self):
+        try:
+            while not self.closed:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                results = self.take_results()
+                wanted  = self.nb_prefetch - self.jobs_queue.qsize()
+                if not self.no_more_jobs and wanted > 0:
+                    works = self.master.get_work_batch(wanted, results)
+                    self.retry_later = works is None
+                    if works is None:
+                        # nothing for now, ask again later
+                        time.sleep(1.0)
+                        self.wakeup.set()
+                        continue
+                    for w in works:
+                        self.jobs_queue.put(w)
+                    if not works:
+                        self.no_more_jobs = True
+                        self.jobs_queue.put("END")
+                    elif len(works) < wanted:
+                        self.wakeup.set() # the master gave less than asked
+                elif results:
+                    self.master.put_results(results)
+        except:
+            print "Exception :", sys.exc_type, sys.exc_value
+            print "warning: prefetcher lost the master, stopping"
+            self.jobs_queue.put("END")
+
+    # results are sent by the feeder thread, with its next call
+    def put_results(self, results):
+        if results:
+            self.lock.acquire()
+            self.results.extend(results)
+            self.lock.release()
+            self.wakeup.set()
+
+    # None when the master has nothing for now, as it does, so that a
+    # caller with results to send is not held here until they are needed
+    def get_work_batch(self, n, previous_results = None):
+        self.put_results(previous_results)
+        res   = []
+        block = True
+        while len(res) < n:
+            try:
+                cmd = self.jobs_queue.get(block, 1.0)
+            except Empty:
+                if not block:
+                    break
+                if self.retry_later:
+                    return None
+                continue
+            block = False
+            if cmd == "END":
+                self.jobs_queue.put(cmd) # for the other workers
+                break
+            res.append(cmd)
+        self.wakeup.set()
+        return res
+
+    def get_begin_end_commands(self):
+        return self.begin_end
+
+    # to be called once all local workers are gone
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.feeder.join()
+        results = self.take_results()
+        if results:
+            self.master.put_results(results)
+        self.master.close()
+
+# in relay mode (-c and -s), leases jobs from the upstream server in big
+# batches, gives them to the local master for our own clients and workers
+# and sends their results back upstream in big batches too, so that the
+# upstream server only sees one client for a whole cluster
+class Relay(Thread):
+
+    def __init__(self, master, upstream, nb_jobs, results_q):
+        Thread.__init__(self)
+        self.master          = master
+        self.upstream        = upstream
+        self.nb_jobs         = nb_jobs # leased from upstream at most
+        self.results_queue   = results_q
+        self.upstream_leases = {} # local job id -> upstream lease id
+        self.no_more_jobs    = False
+        self.next_lease      = 0  # time before which we don't ask upstream
+        # upstream counts us as one worker until it has no more jobs for
+        # us, our clients and workers run its begin and end commands
+        # unless we have ours
+        (begin_cmd, end_cmd) = upstream.get_begin_end_commands()
+        if not master.begin_command:
+            master.begin_command = begin_cmd
+        if not master.end_command:
+            master.end_command = end_cmd
+
+    def lease(self, results):
+        wanted = self.nb_jobs - len(self.upstream_leases)
+        works  = self.upstream.get_work_batch(wanted, results)
+        if works is None:
+            # nothing for now, ask again later
+            self.next_lease = time.time() + 1.0
+        elif not works:
+            self.no_more_jobs = True
+            self.master.add_job("END")
+        else:
+            for (lease_id, cmd) in works:
+                self.upstream_leases[self.master.add_job(cmd)] = lease_id
+
+    def run(self):
+        try:
+            self.forward()
+        except connection_closed:
+            sys.stderr.write("warning: lost the upstream server, its jobs "
+                             "still queued here are dropped\n")
+            # their results could not be sent anywhere, END may be one
+            try:
+                while True:
+                    self.master.jobs_queue.get(False)
+            except Empty:
+                pass
+            self.no_more_jobs = True
+            if not self.master.no_more_jobs:
+                self.master.add_job("END")
+
+    def forward(self):
+        results   = []
+        last_sent = time.time()
+        while not self.no_more_jobs or self.upstream_leases:
+            if (not self.no_more_jobs and time.time() >= self.next_lease and
+                len(self.upstream_leases) <= self.nb_jobs / 2):
+                self.lease(results)
+                results   = []
+                last_sent = time.time()
+                continue
+            try:
+                (job_id, record) = self.results_queue.get(True, 1.0)
+                # upstream wants what a worker would send
+                results.append((self.upstream_leases.pop(job_id), record[1:]))
+            except Empty:
+                pass
+            if results and (len(results) >= self.nb_jobs / 2 or
+                            time.time() - last_sent >= 1.0):
+                self.upstream.put_results(results)
+                results   = []
+                last_sent = time.time()
+        if results:
+            self.upstream.put_results(results)
+
+# reads the commands file in its own thread, so that results can be
+# processed at the same time, a bounded jobs queue makes it wait when
+# workers can't keep up
+class JobsReader(Thread):
+
+    # done_jobs: job id -> command hash of the jobs done by a previous run
+    def __init__(self, master, commands_file, results_q, done_jobs = {}):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.master        = master
+        self.commands_file = commands_file
+        self.results_queue = results_q
+        self.done_jobs     = done_jobs
+        self.nb_jobs       = 0 # to run
+        self.nb_skipped    = 0
+        self.eof           = False
+
+    def run(self):
+        job_id = 0
+        # not "for cmd in file", which reads ahead: commands coming
+        # slowly from a pipe are sent as soon as they are read
+        for cmd in iter(self.commands_file.readline, ""):
+            if (self.done_jobs and
+                self.done_jobs.get(job_id) == hex_hash(cmd)):
+                self.master.skip_job()
+                # no output, but --keep-order must know about it
+                self.results_queue.put((job_id, None))
+                self.nb_skipped += 1
+            else:
+                self.master.add_job(cmd)
+                self.nb_jobs += 1
+            job_id += 1
+        self.eof = True
+        self.master.add_job("END")
+        # wake up the results loop, it may be waiting for nothing
+        self.results_queue.put(None)
+
+# writes job records to the output in the text or binary format, and
+# keeps the index, the journal and the usage log up to date
+class ResultsWriter:
+
+    # output_file is None when nothing has to be output, offset is
+    # where the output file was opened
+    def __init__(self, output_file, output_format = "text",
+                 post_proc_fun = None, index_writer = None, journal = None,
+                 offset = 0, usage_log = None):
+        self.output_file   = output_file
+        self.post_proc_fun = post_proc_fun
+        self.index_writer  = index_writer
+        self.journal       = journal
+        self.usage_log     = usage_log
+        self.offset        = offset # where the next text output goes
+        self.record_writer = None
+        if output_file and output_format == "binary":
+            self.record_writer = RecordWriter(output_file, offset)
+
+    def write(self, job_id, record):
+        if self.record_writer:
+            (offset, length) = self.record_writer.write(job_id, record)
+        elif self.output_file:
+            cmd_and_output = to_text(record)
+            if self.post_proc_fun:
+                cmd_and_output = self.post_proc_fun(cmd_and_output)
+            self.output_file.write(cmd_and_output)
+            offset = self.offset
+            length = len(cmd_and_output)
+            self.offset += length
+        if self.index_writer:
+            self.index_writer.add(job_id, offset, length, record[0])
+        if self.usage_log:
+            self.usage_log.add(job_id, record)
+        if self.journal:
+            self.journal.add(job_id, record[0])
+
 def get_nb_procs():
     res = None
     try:
@@ -86,54 +791,490 @@ def get_nb_procs():
             res = 0
     return res
 
-def worker_wrapper(master, lock):
+# bytes of a job's stdout or stderr kept in memory while it runs,
+# beyond that they go to a temporary file
+capture_spill_size = 1024 * 1024
+
+# output of a job stream, in memory unless it gets big
+class Capture:
+
+    def __init__(self):
+        self.chunks     = []
+        self.size       = 0
+        self.spill_file = None
+
+    def write(self, data):
+        if (self.spill_file is None and
+            self.size + len(data) > capture_spill_size):
+            self.spill_file = tempfile.TemporaryFile()
+            self.spill_file.write("".join(self.chunks))
+            self.chunks = []
+        if self.spill_file is None:
+            self.chunks.append(data)
+        else:
+            self.spill_file.write(data)
+        self.size += len(data)
+
+    def getvalue(self):
+        if self.spill_file is None:
+            return "".join(self.chunks)
+        self.spill_file.seek(0)
+        res = self.spill_file.read()
+        self.spill_file.close()
+        return res
+
+# our resident set in KB, 0 if unknown; a job forked from us counts it
+# in its max RSS, the kernel keeps the peak from before exec
+def resident_kb():
+    try:
+        f = open("/proc/self/statm", 'r')
+        pages = int(f.read().split()[1])
+        f.close()
+    except (EnvironmentError, ValueError, IndexError):
+        return 0
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024
+
+# waits for p, returns the resources it used (user CPU time, system CPU
+# time, max RSS in KB, blocks read, blocks written, our RSS in KB when it
+# was started) or None if unknown; the max RSS is at least the last one
+def wait_job(p):
+    if not hasattr(os, "wait4") or p.returncode is not None: # python 2.4
+        p.wait()
+        return None
+    while True:
+        try:
+            (pid, status, usage) = os.wait4(p.pid, 0)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    return (usage.ru_utime, usage.ru_stime, usage.ru_maxrss,
+            usage.ru_inblock, usage.ru_oublock, p.spawn_rss)
+
+# read stdout and stderr of p from its pipes while it runs,
+# return them once they are closed, p still has to be waited for
+def capture_output(p):
+    if not hasattr(select, "poll"):
+        return p.communicate()
+    out      = p.stdout.fileno()
+    err      = p.stderr.fileno()
+    captures = { out : Capture(), err : Capture() }
+    poller   = select.poll()
+    for fd in captures.keys():
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+    nb_open = len(captures)
+    while nb_open > 0:
+        for (fd, event) in poller.poll():
+            data = os.read(fd, 65536)
+            if data:
+                captures[fd].write(data)
+            else: # end of file
+                poller.unregister(fd)
+                nb_open -= 1
+    p.stdout.close()
+    p.stderr.close()
+    return (captures[out].getvalue(), captures[err].getvalue())
+
+# a command with none of these characters has no meaning for /bin/sh
+# other than a program name followed by its arguments
+shell_metachars = re.compile(r"[|&;<>()$`\\\"'*?\[\]#~=%{}!\n]")
+
+# commands that only exist inside a shell
+shell_builtins = ["alias", "bg", "break", "case", "cd", "continue", "eval",
+                  "exec", "exit", "export", "fg", "for", "if", "jobs",
+                  "read", "return", "set", "shift", "source", "trap",
+                  "ulimit", "umask", "unset", "until", "wait", "while", "."]
+
+# the program and its arguments, or None if cmd needs a shell
+def split_simple_command(cmd):
+    cmd = cmd.strip()
+    if not cmd or shell_metachars.search(cmd):
+        return None
+    argv = cmd.split()
+    if argv[0] in shell_builtins:
+        return None
+    return argv
+
+# preexec_fn for the fast spawn engine: close only the file descriptors
+# that are really open instead of all the possible ones, those marked
+# close-on-exec are left to exec
+def close_inherited_fds():
+    try:
+        fds = map(int, os.listdir("/proc/self/fd"))
+    except OSError:
+        fds = range(3, subprocess.MAXFD)
+    for fd in fds:
+        if fd > 2:
+            try:
+                if not fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC:
+                    os.close(fd)
+            except (IOError, OSError):
+                pass
+
+# runs one job and formats its output
+class JobRunner:
+
+    # capture is "pipe" (read outputs while the job runs)
+    # or "file" (outputs go to temporary files read once the job is done)
+    # spawn is "shell" (always go through /bin/sh)
+    # or "fast" (exec simple commands directly, close only open fds)
+    # with a load probe, each job runs in its own process group so that
+    # the probe can signal the job and all its children
+    # with an input cache, the {in:PATH} of a command are replaced by the
+    # paths of local copies, kept until the job is finished, else by PATH
+    def __init__(self, capture = "pipe", spawn = "shell", probe = None,
+                 inputs = None):
+        self.capture = capture
+        self.spawn   = spawn
+        self.probe   = probe
+        self.inputs  = inputs
+
+    # preexec_fn of the jobs
+    def setup_child(self):
+        if self.probe:
+            os.setpgrp()
+        if self.spawn == "fast":
+            close_inherited_fds()
+
+    def start(self, work, stdout, stderr):
+        (work, pinned) = self.localize(work)
+        try:
+            return self.launch(work, pinned, stdout, stderr)
+        except:
+            self.release_inputs(pinned)
+            raise
+
+    # the command to run for work and the inputs to release once it ran;
+    # copying inputs to the cache can take a while
+    def localize(self, work):
+        if self.inputs:
+            return self.inputs.localize(work)
+        return (declared_input.sub(r"\1", work), [])
+
+    # runs a localized command, if it can't its inputs are still pinned
+    def launch(self, work, pinned, stdout, stderr):
+        spawn_rss = resident_kb()
+        p = self.popen(work, stdout, stderr)
+        p.pinned_inputs = pinned
+        p.spawn_rss     = spawn_rss
+        if self.probe:
+            self.probe.add(p.pid)
+        return p
+
+    def popen(self, work, stdout, stderr):
+        if self.spawn == "fast":
+            argv = split_simple_command(work)
+            if argv is not None:
+                try:
+                    return Popen(argv, stdout=stdout, stderr=stderr,
+                                 close_fds=False,
+                                 preexec_fn=self.setup_child)
+                except OSError:
+                    pass # let the shell report it, e.g. command not found
+            return Popen(work, shell=True, stdout=stdout, stderr=stderr,
+                         close_fds=False, preexec_fn=self.setup_child)
+        preexec_fn = None
+        if self.probe:
+            preexec_fn = os.setpgrp
+        return Popen(work, shell=True, stdout=stdout, stderr=stderr,
+                     close_fds=True, preexec_fn=preexec_fn)
+
+    # p was started by start and has been waited for
+    def finished(self, p):
+        if self.probe:
+            self.probe.remove(p.pid)
+        self.release_inputs(p.pinned_inputs)
+
+    def release_inputs(self, pinned):
+        for h in pinned:
+            self.inputs.release(h)
+
+    # what a worker sends back: (exit status, start time, end time, stdout,
+    # stderr, resources used), the master puts the command in front to
+    # make a record
+    def run(self, work):
+        start = time.time()
+        if self.capture == "pipe":
+            p = self.start(work, PIPE, PIPE)
+            (cmd_stdout, cmd_stderr) = capture_output(p)
+            usage = wait_job(p)
+        else:
+            stdout_file = tempfile.TemporaryFile()
+            stderr_file = tempfile.TemporaryFile()
+            p = self.start(work, stdout_file, stderr_file)
+            usage = wait_job(p) # wait for the command to complete
+            # rewind its stdout and stderr files
+            stdout_file.seek(0)
+            stderr_file.seek(0)
+            cmd_stdout = stdout_file.read()
+            cmd_stderr = stderr_file.read()
+            stdout_file.close()
+            stderr_file.close()
+        self.finished(p)
+        return (p.returncode, start, time.time(), cmd_stdout, cmd_stderr,
+                usage)
+
+# with a scaler, a worker runs jobs only while it holds one of its slots
+def worker_loop(master, batch_size, runner, scaler = None):
     begin_cmd = ""
     end_cmd   = ""
     try:
+        if scaler:
+            scaler.acquire()
         not_started = True
         while not_started:
             try:
-                work = master.get_work()
+                works = master.get_work_batch(batch_size, [])
                 not_started = False
             except:
                 import sys                                            # CC
                 print "Exception :", sys.exc_type, sys.exc_value      # CC
-                print "warning: retrying master.get_work()"
+                print "warning: retrying master.get_work_batch()"
                 time.sleep(0.1)
         (begin_cmd, end_cmd) = master.get_begin_end_commands()
         if begin_cmd != "":
             print "worker start: %s" % commands.getoutput(begin_cmd)
-        while work != "":
-            # there is a bug in StringIO, calling getvalue on one where it
-            # was never written throws an exception instead of returning an
-            # empty string
-            cmd_out = StringIO()
-            cmd_out.write("i:%s" % work)
-            cmd_stdout = tempfile.TemporaryFile()
-            cmd_stderr = tempfile.TemporaryFile()
-            p = Popen(work, shell=True, stdout=cmd_stdout, stderr=cmd_stderr,
-                      close_fds=True)
-            p.wait() # wait for the command to complete
-            # rewind its stdout and stderr files
-            cmd_stdout.seek(0)
-            cmd_stderr.seek(0)
-            for l in cmd_stdout:
-                cmd_out.write("o:%s" % l)
-            cmd_stdout.close()
-            for l in cmd_stderr:
-                cmd_out.write("e:%s" % l)
-            cmd_stderr.close()
-            in_out_err = cmd_out.getvalue()
-            cmd_out.close()
-            # FBR: compression hook should be here
-            #      this could be pretty big stuff to send
-            work = master.get_work(in_out_err)
-    except ConnectionClosedError: # server closed because no more jobs to send
+        # None means nothing to do right now, but the run is not over
+        while works != []:
+            results = []
+            if works is None:
+                time.sleep(1.0)
+            else:
+                for (lease_id, work) in works:
+                    results.append((lease_id, runner.run(work)))
+                    if scaler:
+                        scaler.job_done()
+            if scaler and not scaler.keep_slot():
+                # less jobs at the same time now, wait for a slot
+                master.put_results(results)
+                results = []
+                scaler.acquire()
+            if runner.probe and not runner.probe.is_ok():
+                # the node is overloaded, don't lease more jobs for now
+                master.put_results(results)
+                results = []
+                runner.probe.wait_ok()
+            works = master.get_work_batch(batch_size, results)
+    except connection_closed: # server closed because no more jobs to send
         pass
+    if scaler:
+        scaler.release()
     #print "no more jobs for me, leaving"
     if end_cmd != "":
         print "worker stop: %s" % commands.getoutput(end_cmd)
-    lock.release()
+
+# the lock is released even if the worker died, else the client would
+# wait for it forever
+def worker_wrapper(master, lock, batch_size, runner, scaler = None):
+    try:
+        worker_loop(master, batch_size, runner, scaler)
+    finally:
+        lock.release()
+
+# a job started by a PollExecutor
+class RunningJob:
+
+    def __init__(self, lease_id, work, p):
+        self.lease_id = lease_id
+        self.work     = work
+        self.p        = p
+        self.captures = { p.stdout.fileno() : Capture(),
+                          p.stderr.fileno() : Capture() }
+        self.start    = time.time()
+
+# runs up to nb_slots jobs at the same time from a single thread which
+# polls their outputs, instead of one worker thread blocked per job;
+# the master is talked to by a messenger thread, so that its answers
+# never hold back the reading of outputs
+class PollExecutor:
+
+    # with a scaler, nb_slots is the scaler's current limit
+    def __init__(self, master, nb_slots, batch_size, runner, scaler = None):
+        self.master       = master
+        self.nb_slots     = nb_slots
+        self.scaler       = scaler
+        self.batch_size   = batch_size
+        self.runner       = runner
+        self.cond         = Condition()
+        self.jobs         = deque() # leased, not started yet, localized
+        self.results      = []      # not sent yet
+        self.nb_running   = 0
+        self.max_running  = 0       # once jobs could not be started
+        self.no_more_jobs = False
+        self.closing      = False
+        # the messenger wakes up the poll loop by writing to this pipe
+        (self.wake_r, self.wake_w) = os.pipe()
+        if runner.probe:
+            runner.probe.listeners.append(self.wake_messenger)
+        if scaler:
+            scaler.listeners.append(self.wake_messenger)
+
+    def slots(self):
+        res = self.nb_slots
+        if self.scaler:
+            res = self.scaler.limit
+        if self.max_running:
+            res = min(res, self.max_running)
+        return res
+
+    # cond must be held
+    def nb_wanted(self):
+        if self.no_more_jobs:
+            return 0
+        if self.runner.probe and not self.runner.probe.is_ok():
+            return 0 # the node is overloaded
+        free = self.slots() - self.nb_running - len(self.jobs)
+        return min(free, self.batch_size)
+
+    # jobs can be leased again
+    def wake_messenger(self):
+        self.cond.acquire()
+        self.cond.notify()
+        self.cond.release()
+
+    def talk(self):
+        while True:
+            self.cond.acquire()
+            while (not self.closing and not self.results and
+                   self.nb_wanted() <= 0):
+                self.cond.wait()
+            results      = self.results
+            self.results = []
+            wanted       = self.nb_wanted()
+            closing      = self.closing
+            self.cond.release()
+            if wanted > 0 and not closing:
+                works = self.master.get_work_batch(wanted, results)
+                if works is None:
+                    # nothing for now, ask again later
+                    time.sleep(1.0)
+                    continue
+                if not works:
+                    self.cond.acquire()
+                    self.no_more_jobs = True
+                    self.cond.release()
+                    os.write(self.wake_w, "x")
+                # inputs are copied here, not by the poll loop which must
+                # keep reading the outputs of the running jobs; each job
+                # can start as soon as its inputs are there
+                for (lease_id, work) in works:
+                    localized = self.runner.localize(work)
+                    self.cond.acquire()
+                    self.jobs.append((lease_id, localized))
+                    self.cond.release()
+                    os.write(self.wake_w, "x")
+            elif results:
+                self.master.put_results(results)
+            elif closing:
+                break
+
+    # start as many leased jobs as there are free slots, cond is not held
+    # while a job is started
+    def start_jobs(self, poller, running):
+        self.cond.acquire()
+        while self.jobs and self.nb_running < self.slots():
+            (lease_id, (work, pinned)) = self.jobs.popleft()
+            self.nb_running += 1
+            self.cond.release()
+            try:
+                job = RunningJob(lease_id, work,
+                                 self.runner.launch(work, pinned, PIPE, PIPE))
+            except OSError, e: # e.g. no more fds for its pipes
+                job = None
+            self.cond.acquire()
+            if job is None:
+                self.nb_running -= 1
+                self.cannot_start(lease_id, (work, pinned), e)
+                continue
+            for fd in job.captures.keys():
+                poller.register(fd, select.POLLIN | select.POLLPRI)
+                running[fd] = job
+        self.cond.notify() # maybe more jobs are wanted
+        self.cond.release()
+
+    # cond must be held; the job waits for a running one to finish, and no
+    # more jobs than now are run at the same time, if none runs it fails
+    # localized is (command, pinned inputs)
+    def cannot_start(self, lease_id, localized, error):
+        if self.nb_running == 0:
+            self.runner.release_inputs(localized[1])
+            now = time.time()
+            self.results.append((lease_id, (127, now, now, "",
+                                            "error: can't start job: %s\n" %
+                                            error, None)))
+            return
+        self.jobs.appendleft((lease_id, localized))
+        if self.max_running == 0 or self.nb_running < self.max_running:
+            self.max_running = self.nb_running
+            sys.stderr.write("warning: can't start more jobs (%s), at most "
+                             "%d will run at the same time\n" %
+                             (error, self.max_running))
+
+    def job_done(self, job):
+        cmd_stdout = job.captures[job.p.stdout.fileno()].getvalue()
+        cmd_stderr = job.captures[job.p.stderr.fileno()].getvalue()
+        job.p.stdout.close()
+        job.p.stderr.close()
+        usage = wait_job(job.p)
+        self.runner.finished(job.p)
+        if self.scaler:
+            self.scaler.job_done()
+        res = (job.p.returncode, job.start, time.time(), cmd_stdout,
+               cmd_stderr, usage)
+        self.cond.acquire()
+        self.results.append((job.lease_id, res))
+        self.nb_running -= 1
+        self.cond.notify()
+        self.cond.release()
+
+    def run(self):
+        (begin_cmd, end_cmd) = self.master.get_begin_end_commands()
+        if begin_cmd != "":
+            print "worker start: %s" % commands.getoutput(begin_cmd)
+        messenger = Thread(target = self.talk)
+        messenger.start()
+        poller  = select.poll()
+        poller.register(self.wake_r, select.POLLIN)
+        running = {} # output fd -> job
+        try:
+            self.start_jobs(poller, running)
+            while running or self.jobs or not self.no_more_jobs:
+                for (fd, event) in poller.poll():
+                    if fd == self.wake_r:
+                        os.read(fd, 4096)
+                        continue
+                    job  = running[fd]
+                    data = os.read(fd, 65536)
+                    if data:
+                        job.captures[fd].write(data)
+                    else: # end of file
+                        poller.unregister(fd)
+                        del running[fd]
+                        if not (running.has_key(job.p.stdout.fileno()) or
+                                running.has_key(job.p.stderr.fileno())):
+                            self.job_done(job)
+                self.start_jobs(poller, running)
+        finally:
+            # even if this loop died, the messenger must not wait forever
+            self.cond.acquire()
+            self.closing = True
+            self.cond.notify()
+            self.cond.release()
+            messenger.join() # sends the last results
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+        if end_cmd != "":
+            print "worker stop: %s" % commands.getoutput(end_cmd)
+
+def executor_wrapper(executor, lock):
+    try:
+        executor.run()
+    finally:
+        lock.release()
 
 default_rfoo_port     = rfoo.DEFAULT_PORT                             # CC
 rfoo_daemon_loop_cond = True
@@ -142,10 +1283,42 @@ optparse_usage = """Usage: %prog [options] {-i | -c} ...
 Execute commands in a parallel and/or distributed way."""
 
 my_parser = OptionParser(usage = optparse_usage)
+my_parser.add_option("--autoscale",
+                     dest = "autoscale", default = 0,
+                     help = ("tune the number of jobs run at the same time "
+                             "while they run, between 1 and this maximum, "
+                             "for the most jobs done per minute, starting "
+                             "from -w; it goes down when available memory "
+                             "is under --min-free-mem"))
 my_parser.add_option("-b", "--begin",
                      dest   = "begin_command", default = "",
                      help   = ("command run by a worker before any job "
                                "(englobe command in parenthesis)"))
+my_parser.add_option("--batch",
+                     dest = "batch_size", default = 1,
+                     help = ("maximum number of jobs a worker leases from "
+                             "the master in one call, results are sent back "
+                             "the same way (default is 1)"))
+my_parser.add_option("--cache",
+                     dest = "cache", default = None,
+                     help = ("with -i, directory where the results of "
+                             "successful jobs are kept, a job with the same "
+                             "command and the same contents of the files "
+                             "named in its command is not run again, its "
+                             "result is taken from there"))
+my_parser.add_option("--cache-size",
+                     dest = "cache_size", default = 1024,
+                     help = ("MB used at most by --cache, the least "
+                             "recently used results are removed beyond "
+                             "that (default is 1024)"))
+my_parser.add_option("--capture",
+                     dest = "capture", default = "pipe",
+                     choices = ["pipe", "file"],
+                     help = ("how jobs' stdout and stderr are captured: "
+                             "'pipe' reads them while the job runs, "
+                             "going to a temporary file only for big "
+                             "outputs (default), 'file' always uses "
+                             "temporary files"))
 my_parser.add_option("-c", "--client",
                      dest = "server_name", default = None,
                      help = ("read commands from a server instead of a file "
@@ -157,16 +1330,109 @@ my_parser.add_option("-e", "--end",
                      dest = "end_command", default = "",
                      help = "command run by a worker after last job "
                             "(englobe command in parenthesis)")
+my_parser.add_option("--executor",
+                     dest = "executor", default = "threads",
+                     choices = ["threads", "poll"],
+                     help = ("'threads' runs each of the -w local jobs from "
+                             "its own worker thread (default), 'poll' "
+                             "supervises all of them from a single thread, "
+                             "for thousands of concurrent jobs"))
+my_parser.add_option("--history",
+                     dest = "history", default = None,
+                     help = ("keep the runtimes of commands in this file "
+                             "from one run to the next, to predict how "
+                             "long jobs will take (see --order)"))
 my_parser.add_option("-i", "--input",
                      dest = "commands_file", default = None,
                      help = ("/dev/stdin for example "
                              "(incompatible with -c)"))
+my_parser.add_option("--index",
+                     action = "store_true",
+                     dest   = "with_index", default = False,
+                     help   = ("with -o, also write where the output of each "
+                               "job is in the log to the LOG.idx file, see "
+                               "src/LogIndex.py to get one job's output from "
+                               "it"))
+my_parser.add_option("--input-cache",
+                     dest = "input_cache", default = None,
+                     help = ("directory where this node keeps local copies "
+                             "of the files declared as {in:PATH} in "
+                             "commands, a job gets the path of the copy "
+                             "instead of PATH, which is only read again "
+                             "when it changed"))
+my_parser.add_option("--input-cache-size",
+                     dest = "input_cache_size", default = 10240,
+                     help = ("MB used at most by --input-cache, the least "
+                             "recently used files are removed beyond that "
+                             "(default is 10240)"))
+my_parser.add_option("--journal",
+                     dest = "journal", default = None,
+                     help = ("with -i, write the ids of the jobs whose "
+                             "output was written to this file, regularly "
+                             "flushed to disk together with the output, "
+                             "so that the run can be resumed with --resume"))
+my_parser.add_option("--keep-order",
+                     action = "store_true",
+                     dest   = "keep_order", default = False,
+                     help   = ("output results in the order of the commands "
+                             "instead of the order jobs finish, results "
+                             "waiting for a slower job go to a temporary "
+                             "file in $TMPDIR beyond --results-memory MB "
+                             "(100 if not given)"))
+my_parser.add_option("--lease-time",
+                     dest = "lease_time", default = 0,
+                     help = ("with -s, seconds after which a job leased "
+                             "to a worker that stopped renewing its lease "
+                             "(i.e. that died) is sent to another worker, "
+                             "running workers renew their leases every "
+                             "third of that time (default is 0, jobs are "
+                             "never sent again)"))
+my_parser.add_option("--load-probe",
+                     dest = "load_probe", default = None,
+                     help = ("when the load average goes over --max-load or "
+                             "the available memory under --min-free-mem, "
+                             "send this signal (a name like STOP or USR1, "
+                             "or a number) to running jobs and lease no "
+                             "more jobs until the node is back to normal; "
+                             "jobs stopped with STOP get CONT then"))
+my_parser.add_option("--max-load",
+                     dest = "max_load", default = None,
+                     help = ("with --load-probe, highest 1 minute load "
+                             "average (default is the number of CPUs)"))
+my_parser.add_option("--metrics-port",
+                     dest = "metrics_port", default = 0,
+                     help = ("with -s, serve counters and histograms of "
+                             "the master over HTTP on this port, in the "
+                             "Prometheus text format"))
+my_parser.add_option("--min-free-mem",
+                     dest = "min_free_mem", default = 10,
+                     help = ("with --load-probe or --autoscale, lowest "
+                             "percentage of available memory (default is "
+                             "10)"))
 my_parser.add_option("-m", "--mux",
                      dest = "muxer", default = None,
                      help = "specify a muxer, NOT IMPLEMENTED")
+my_parser.add_option("--order",
+                     dest = "order", default = "input",
+                     choices = ["input", "lpt"],
+                     help = ("order in which the master gives jobs: "
+                             "'input' is the order of the input file "
+                             "(default), 'lpt' gives the longest jobs "
+                             "first according to --history, once the whole "
+                             "input was read or --queue-size jobs are "
+                             "queued"))
 my_parser.add_option("-o", "--output",
                      dest = "output_file", default = None,
                      help = "log to a file instead of stdout")
+my_parser.add_option("--output-format",
+                     dest = "output_format", default = "text",
+                     choices = ["text", "binary"],
+                     help = ("'text' prefixes the command with 'i:' and "
+                             "each line of its stdout and stderr with 'o:' "
+                             "and 'e:' (default), 'binary' writes "
+                             "length-prefixed records with job id, command, "
+                             "exit status, times, stdout and stderr as they "
+                             "are, see src/RecordFile.py to read them"))
 my_parser.add_option("-p", "--port",
                      dest = "server_port", default = default_rfoo_port,
                      help = ("use a specific port number instead of rfoo's "
@@ -177,10 +1443,89 @@ my_parser.add_option("--post-proc",
                      dest = "post_proc", default = None,
                      help = ("specify a Python post processing module "
                              "(omit the '.py' extension)"))
+my_parser.add_option("--stage",
+                     action = "append", dest = "stage_files", default = [],
+                     help = ("with -s, copy this file to the clients before "
+                             "they run jobs (can be repeated): clients fetch "
+                             "its chunks from the server and from each "
+                             "other, jobs find it in the directory "
+                             "$PAR_STAGE_DIR"))
+my_parser.add_option("--stage-dir",
+                     dest = "stage_dir",
+                     default = os.path.join(tempfile.gettempdir(),
+                                            "par_stage"),
+                     help = ("where staged files go, on the clients and "
+                             "on the server as links (default is "
+                             "/tmp/par_stage)"))
+my_parser.add_option("--stage-port",
+                     dest = "stage_port", default = default_stage_port,
+                     help = ("with --stage, port the staged files are "
+                             "served on, clients get it from the server"))
+my_parser.add_option("--schedule",
+                     dest = "schedule", default = "fixed",
+                     choices = ["fixed", "guided", "factoring"],
+                     help = ("how the master sizes each lease: "
+                             "'fixed' gives what the worker asked for with "
+                             "--batch (default), 'guided' and 'factoring' "
+                             "give big leases early and small ones late, "
+                             "computed from the remaining jobs and the "
+                             "number of active workers and capped by the "
+                             "workers' --batch"))
+my_parser.add_option("--prefetch",
+                     dest = "nb_prefetch", default = 0,
+                     help = ("with -c, number of jobs kept leased in "
+                             "advance by this client so that workers never "
+                             "wait for the server between two jobs "
+                             "(default is 0, no prefetching)"))
+my_parser.add_option("--queue-size",
+                     dest = "queue_size", default = 0,
+                     help = ("maximum number of commands read in advance "
+                             "from the -i input, for very big commands files "
+                             "(default is 0, no limit)"))
+my_parser.add_option("--results-memory",
+                     dest = "results_memory", default = 0,
+                     help = ("MB of results waiting to be written that are "
+                             "kept in memory, the next ones are compressed "
+                             "to a temporary file in $TMPDIR until the "
+                             "output catches up (default is 0, no limit)"))
+my_parser.add_option("--relay-batch",
+                     dest = "relay_batch", default = 1000,
+                     help = ("with -c and -s, this server relays jobs from "
+                             "the -c server (on --upstream-port, default "
+                             "is -p) to its own clients: maximum "
+                             "number of jobs leased at once from the -c "
+                             "server, results are sent back in batches of "
+                             "about half that (default is 1000)"))
+my_parser.add_option("--resume",
+                     action = "store_true",
+                     dest   = "resume", default = False,
+                     help   = ("with --journal, skip the jobs of the same "
+                               "commands file which are in the journal and "
+                               "append to the outputs of the interrupted run"))
+my_parser.add_option("--rusage",
+                     dest = "rusage", default = None,
+                     help = ("write the resources used by each job (wall, "
+                             "user and system time, max RSS, blocks read "
+                             "and written) to this file, and list the "
+                             "slowest and heaviest commands at the end"))
 my_parser.add_option("-s", "--server",
                      action = "store_true",
                      dest   = "is_server", default = False,
                      help   = "accept remote workers")
+my_parser.add_option("--spawn",
+                     dest = "spawn", default = "shell",
+                     choices = ["shell", "fast"],
+                     help = ("how jobs are started: 'shell' runs each "
+                             "command with /bin/sh (default), 'fast' runs "
+                             "commands without shell special characters "
+                             "directly and closes only the open file "
+                             "descriptors in the child, for many tiny jobs"))
+my_parser.add_option("--upstream-port",
+                     dest = "upstream_port", default = None,
+                     help = ("with -c, port of the server to connect to "
+                             "(default is -p); with -c and -s, lets a relay "
+                             "listen on -p and its server use another port, "
+                             "e.g. both on the same host"))
 my_parser.add_option("-v", "--verbose",
                      action = "store_true",
                      dest   = "is_verbose", default = False,
@@ -191,6 +1536,22 @@ my_parser.add_option("-w", "--workers",
                              "must be >= 0, "
                              "default is number of detected cores, very "
                              "probably 0 if your OS is not Linux"))
+my_parser.add_option("-z", "--compress",
+                     action = "store_true",
+                     dest   = "compress", default = False,
+                     help   = ("with -s, compress with zlib jobs and results "
+                               "exchanged with clients when it makes them "
+                               "smaller, statistics are printed at the end"))
+
+# when resuming, the output continues where its journal was committed
+def open_output(file_name, resume, size = None):
+    if not (resume and os.path.exists(file_name)):
+        return open(file_name, 'wb')
+    res = open(file_name, 'r+b')
+    if size is not None:
+        res.truncate(size)
+    res.seek(0, 2) # end of file
+    return res
 
 def usage():
     my_parser.print_help()
@@ -207,6 +1568,34 @@ if __name__ == '__main__':
         remote_server_name    = options.server_name
         connect_to_server     = remote_server_name
         nb_workers            = options.nb_local_workers
+        batch_size            = int(options.batch_size)
+        nb_prefetch           = int(options.nb_prefetch)
+        lease_time            = float(options.lease_time)
+        queue_size            = int(options.queue_size)
+        results_memory        = int(options.results_memory)
+        executor              = options.executor
+        keep_order            = options.keep_order
+        output_format         = options.output_format
+        with_index            = options.with_index
+        journal_option        = options.journal
+        rusage_option         = options.rusage
+        history_option        = options.history
+        metrics_port          = int(options.metrics_port)
+        stage_files           = options.stage_files
+        stage_dir             = options.stage_dir
+        stage_port            = int(options.stage_port)
+        resume                = options.resume
+        cache_option          = options.cache
+        cache_size            = int(options.cache_size)
+        input_cache_option    = options.input_cache
+        input_cache_size      = int(options.input_cache_size)
+        relay_batch           = int(options.relay_batch)
+        upstream_port         = int(options.upstream_port or
+                                    options.server_port)
+        load_probe_option     = options.load_probe
+        max_load              = options.max_load
+        min_free_mem          = float(options.min_free_mem)
+        max_jobs              = int(options.autoscale)
         nb_threads            = get_nb_procs() # automatic detection
         has_nb_workers_option = nb_workers
         post_proc_option      = options.post_proc
@@ -216,8 +1605,20 @@ if __name__ == '__main__':
         muxer                 = options.muxer
         demuxer               = options.demuxer
         daemon                = None
+        usage_mode = 'w'
+        if resume:
+            usage_mode = 'a'
+        if resume and not journal_option:
+            print "error: --resume needs --journal"
+            usage()
+        done_jobs    = {}
+        output_size  = 0
+        journal_size = 0
+        if resume and os.path.exists(journal_option):
+            (done_jobs, output_size, journal_size) = \
+                read_journal(journal_option)
         if output_to_file:
-            output_file = open(output_file_option, 'w')
+            output_file = open_output(output_file_option, resume, output_size)
         if read_from_file:  # mandatory option
             commands_file  = open(commands_file_option, 'r')
         elif not connect_to_server:
@@ -231,6 +1632,31 @@ if __name__ == '__main__':
             print ("fatal: unable to find the number of CPU, "
                    "use the -w option")
             usage()
+        if batch_size < 1:
+            print "error: --batch must be >= 1"
+            usage()
+        if relay_batch < 1:
+            print "error: --relay-batch must be >= 1"
+            usage()
+        if max_jobs and max_jobs < nb_threads:
+            print "error: --autoscale must be >= -w"
+            usage()
+        scaler = None
+        if max_jobs and nb_threads > 0:
+            scaler = AutoScaler(nb_threads, max_jobs, min_free_mem)
+            scaler.start()
+        load_probe = None
+        if load_probe_option:
+            try:
+                pause_signal = signal_number(load_probe_option)
+            except ValueError, e:
+                print "error: --load-probe: %s" % e
+                usage()
+            if max_load is None:
+                max_load = get_nb_procs()
+            load_probe = LoadProbe(pause_signal, float(max_load),
+                                   min_free_mem)
+            load_probe.start()
         if has_post_proc_option:
             module = __import__(post_proc_option)
             post_proc_fun = module.post_proc
@@ -238,21 +1664,144 @@ if __name__ == '__main__':
         if read_from_file and connect_to_server:
             print "error: -c and -i are exclusive"
             usage()
-        commands_queue = Queue()
-        results_queue  = Queue()
+        if output_format == "binary" and has_post_proc_option:
+            print "error: --post-proc needs the text output format"
+            usage()
+        if with_index and not output_to_file:
+            print "error: --index needs -o"
+            usage()
+        if rusage_option and not read_from_file:
+            print "error: --rusage needs -i"
+            usage()
+        if stage_files and not is_server:
+            print "error: --stage needs -s"
+            usage()
+        if metrics_port and not is_server:
+            print "error: --metrics-port needs -s"
+            usage()
+        if history_option and not read_from_file:
+            print "error: --history needs -i"
+            usage()
+        if options.order == "lpt" and not history_option:
+            print "error: --order lpt needs --history"
+            usage()
+        if read_from_file:
+            index_writer = None
+            index_file   = None
+            if with_index:
+                index_file   = open_output(index_file_name(output_file_option),
+                                           resume)
+                index_writer = IndexWriter(index_file)
+                if resume:
+                    index_writer.keep_only(done_jobs)
+            journal = None
+            if journal_option:
+                output_to_sync = None
+                if output_to_file:
+                    output_to_sync = output_file
+                # what was not committed is done again
+                journal = Journal(open_output(journal_option, resume,
+                                              journal_size),
+                                  output_to_sync, index_file)
+            usage_log = None
+            if rusage_option:
+                usage_log = UsageLog(open(rusage_option, usage_mode), resume)
+            if output_to_file:
+                results_writer = ResultsWriter(output_file, output_format,
+                                               post_proc_fun, index_writer,
+                                               journal, output_size,
+                                               usage_log)
+            elif not show_progress:
+                results_writer = ResultsWriter(sys.stdout, output_format,
+                                               post_proc_fun, None, journal,
+                                               usage_log = usage_log)
+            else:
+                results_writer = ResultsWriter(None, journal = journal,
+                                               usage_log = usage_log)
+        history = None
+        if history_option:
+            history = RuntimeHistory(history_option)
+        # a bounded queue blocks the reader when workers can't keep up
+        if options.order == "lpt":
+            commands_queue = LongestFirstQueue(history, queue_size)
+        else:
+            commands_queue = Queue(queue_size)
+        if results_memory > 0:
+            # results waiting to be written beyond that go to disk
+            results_queue = SpillQueue(results_memory * 1024 * 1024)
+        else:
+            results_queue = Queue()
+        cache = None
+        if cache_option:
+            cache = ResultCache(cache_option, cache_size * 1024 * 1024)
+        metrics = None
+        if metrics_port:
+            metrics = Metrics()
         master = Master(commands_queue, results_queue,
-                        options.begin_command, options.end_command)
-        nb_jobs        = 0
+                        options.begin_command, options.end_command,
+                        options.schedule, lease_time, options.compress,
+                        cache, metrics)
+        if metrics:
+            metrics_server = MetricsServer(metrics_port, metrics)
+            metrics_server.start()
+        if stage_files:
+            stage_server = StageServer(stage_port, True)
+            for path in stage_files:
+                stage_server.publish(path)
+            stage_server.start()
+            master.stage_port = stage_port
+            link_all(stage_files, stage_dir)
+            os.environ["PAR_STAGE_DIR"] = stage_dir # for our jobs
         locks          = []
         if is_server:
-            rfoo.start_server( host=host, 
-                               port=int(options.server_port), 
-                               handler=Master)                        # CC
+            # serves clients from its own threads, on all interfaces
+            server = rfoo.InetServer(MasterHandler, master)           # CC
+            server_thread = Thread(target = server.start,
+                                   args = ("", int(options.server_port)))
+            server_thread.setDaemon(True)
+            server_thread.start()
         if connect_to_server:
-            master = rfoo.connect( host=remote_server_name, 
-                                   port=int(options.server_port) )    # CC
-            
+            upstream = RemoteMaster(remote_server_name, upstream_port) # CC
+            upstream_stage_port = upstream.get_stage_port()
+            if upstream.negotiate_compression(["zlib"]) == "zlib":
+                upstream = PackedMaster(upstream)
+            # our stage server keeps serving staged files to other clients
+            if (upstream_stage_port and
+                stage_from((remote_server_name, upstream_stage_port),
+                           stage_dir)):
+                os.environ["PAR_STAGE_DIR"] = stage_dir
+            if not is_server:
+                master = upstream
+        input_cache = None
+        if input_cache_option:
+            input_cache = InputCache(input_cache_option,
+                                     input_cache_size * 1024 * 1024)
+        runner = JobRunner(options.capture, options.spawn, load_probe,
+                           input_cache)
+        # what workers talk to
+        work_source = master
+        if master.get_lease_time() > 0:
+            work_source = LeaseKeeper(work_source, master.get_lease_time())
+        if connect_to_server and not is_server and nb_prefetch > 0:
+            work_source = Prefetcher(work_source, nb_prefetch)
+        relay = None
+        if connect_to_server and is_server:
+            if upstream.get_lease_time() > 0:
+                upstream = LeaseKeeper(upstream, upstream.get_lease_time())
+            relay = Relay(master, upstream, relay_batch, results_queue)
+            relay.start()
+
         # start workers
+        if executor == "poll" and nb_threads > 0:
+            l = thread.allocate_lock()
+            l.acquire()
+            locks.append(l)
+            poll_executor = PollExecutor(work_source, nb_threads, batch_size,
+                                         runner, scaler)
+            thread.start_new_thread(executor_wrapper, (poll_executor, l))
+            nb_threads = 0 # no worker thread
+        elif scaler:
+            nb_threads = max_jobs # the scaler says how many can work
         for i in range(nb_threads):
             l = thread.allocate_lock()
             l.acquire()
@@ -264,50 +1813,93 @@ if __name__ == '__main__':
                              # It is like if the Pyro daemon is not ready yet
                              # to handle many new client threads...
                              # CC: is it still necessary with rfoo instead of Pyro?
-            thread.start_new_thread(worker_wrapper, (master, l))
-        # feed workers
+            thread.start_new_thread(worker_wrapper,
+                                    (work_source, l, batch_size, runner,
+                                     scaler))
+        if keep_order:
+            # results waiting for a straggler beyond that go to disk
+            reorder_memory = 100
+            if results_memory > 0:
+                reorder_memory = results_memory
+            reorder_buffer = ReorderBuffer(reorder_memory * 1024 * 1024)
         if read_from_file:
-            # read jobs from local file
-            for cmd in commands_file:
-                master.add_job(cmd)
-                nb_jobs += 1
-            master.add_job("END")
-        if read_from_file:
-            progress_bar = ProgressBar(0, nb_jobs)
+            # feed workers while results are processed
+            reader = JobsReader(master, commands_file, results_queue,
+                                done_jobs)
+            reader.start()
+            # the number of jobs is unknown until the whole input was read
+            progress_bar = ProgressBar(0, None, lambda: master.nb_workers)
             # output everything
             jobs_done = 0
             if show_progress:
                 progress_bar.draw()
-            while jobs_done < nb_jobs:
-                cmd_and_output = results_queue.get()
-                jobs_done += 1
-                # FBR: more code factorization possible here
-                #      if there is a default post_proc function which
-                #      is the identity function
-                if output_to_file:
-                    if has_post_proc_option:
-                        output_file.write(post_proc_fun(cmd_and_output))
-                    else:
-                        output_file.write(cmd_and_output)
+            while not reader.eof or jobs_done < reader.nb_jobs:
+                result = results_queue.get()
+                if result is None: # end of input
+                    progress_bar.set_max(reader.nb_jobs)
+                    if show_progress:
+                        progress_bar.draw(True)
+                    continue
+                if result[1] is not None: # else done by a previous run
+                    jobs_done += 1
+                    if cache:
+                        cache.store(result[0], result[1])
+                    if history:
+                        (cmd, status, start, end) = result[1][:4]
+                        history.add(cmd, end - start)
+                if keep_order:
+                    ready = reorder_buffer.add(result[0], result[1])
+                else:
+                    ready = [result]
+                for (job_id, record) in ready:
+                    if record is not None:
+                        results_writer.write(job_id, record)
                 if show_progress:
                     progress_bar.update(jobs_done)
-                    progress_bar.draw()
-                elif not output_to_file:
-                    if has_post_proc_option:
-                        sys.stdout.write(post_proc_fun(cmd_and_output))
-                    else:
-                        sys.stdout.write(cmd_and_output)
+                    progress_bar.draw() # only every ProgressBar.min_period
+            if show_progress:
+                progress_bar.set_max(reader.nb_jobs)
+                progress_bar.draw(True)
+            if reader.nb_skipped > 0:
+                sys.stderr.write("resume: %d jobs were already done\n" %
+                                 reader.nb_skipped)
+            if cache:
+                sys.stderr.write("cache: %s\n" % cache.report())
+            if is_server and options.compress:
+                sys.stderr.write("compression: %s\n" % master.codec.report())
             # cleanup
             rfoo_daemon_loop_cond = False
             commands_file.close()
+            if journal:
+                journal.close()
             if output_to_file:
                 output_file.close()
+            if index_writer:
+                index_file.close()
+            if history:
+                history.save()
+            if usage_log:
+                usage_log.close()
+                sys.stderr.write(usage_log.summary())
         # wait for everybody
         for l in locks:
             l.acquire()
+        if scaler:
+            sys.stderr.write("autoscale: %s\n" % scaler.report())
+        if load_probe:
+            sys.stderr.write("load probe: %s\n" % load_probe.report())
+        if input_cache:
+            sys.stderr.write("input cache: %s\n" % input_cache.report())
+        if relay:
+            relay.join() # sends the last results upstream
+            upstream.close()
         # Nothing to close server-side -- close the clients' connections
-        if not is_server:                                             # CC
-            master.close()                                            # CC
+        elif connect_to_server:                                       # CC
+            work_source.close()                                       # CC
+        if is_server:
+            master.wait_for_clients(10.0)
+        if metrics:
+            metrics_server.stop()
     except SystemExit:
         pass
     except: # unexpected one
@@ -32,4 +32,74 @@ fi
 cat test_parallel.input | ./bin/par.sh -i /dev/stdin $nb_procs \
 | egrep "^o:" | sed "s/^o://g" | sort -n > test_parallel.output
 
-diff test_parallel.output test_parallel.output.reference
+diff test_parallel.output test_parallel.output.reference || exit 1
+
+# with --keep-order, outputs come in the order of the commands, not in the
+# order jobs finish: the first ones are the slowest, no sort
+seq 1 10 | sed "s/.*/sleep 0.\$((10 - &)); echo &/" \
+| ./bin/par.sh -i /dev/stdin -w 4 --keep-order \
+| egrep "^o:" | sed "s/^o://g" > test_parallel.output
+diff test_parallel.output test_parallel.output.reference || exit 1
+
+# a run interrupted twice, then resumed: every job output exactly once
+# jobs interrupt parallel.py ($PPID of their shell) once each, job 2 is left
+# uncommitted by the first run and still running when the second stops
+tmp=`mktemp -d`
+cat > $tmp/jobs <<EOF
+echo 0
+sleep 1.5; echo 1
+if [ -f $tmp/k1 -a ! -f $tmp/k2 ]; then sleep 10; fi; echo 2
+if [ ! -f $tmp/k1 ]; then touch $tmp/k1; sleep 0.5; kill -INT \$PPID; fi; echo 3
+sleep 1.5; echo 4
+if [ ! -f $tmp/k2 ]; then touch $tmp/k2; sleep 0.5; kill -INT \$PPID; fi; echo 5
+EOF
+./bin/par.sh -i $tmp/jobs -o $tmp/out --journal $tmp/journal -w 1
+./bin/par.sh -i $tmp/jobs -o $tmp/out --journal $tmp/journal -w 2 --resume
+./bin/par.sh -i $tmp/jobs -o $tmp/out --journal $tmp/journal -w 2 --resume
+egrep "^o:" $tmp/out | sed "s/^o://g" | sort -n > $tmp/done
+seq 0 5 | diff - $tmp/done || exit 1
+rm -rf $tmp
+
+# same jobs, run by a client of a server without local workers
+# client_test PORT CLIENT_OPTIONS...
+client_test () {
+    port=$1
+    shift
+    rm -f test_parallel.output
+    cat test_parallel.input | ./bin/par.sh -i /dev/stdin -s -w 0 -p $port \
+    | egrep "^o:" | sed "s/^o://g" | sort -n > test_parallel.output &
+    server=$!
+    sleep 1
+    ./bin/par.sh -c localhost -p $port "$@"
+    wait $server
+    diff test_parallel.output test_parallel.output.reference
+}
+
+client_test 52440 $nb_procs || exit 1
+# a client killed and a client stopped while they run jobs: their jobs are
+# sent to another client once their leases expire, and the late result of
+# the stopped one is discarded, every job is output exactly once
+tmp=`mktemp -d`
+seq 0 7 | sed "s/^/sleep 1; echo /" > $tmp/jobs
+./bin/par.sh -i $tmp/jobs -o $tmp/out -s -w 0 -p 52443 --lease-time 2 \
+    2> $tmp/err &
+server=$!
+sleep 1
+./bin/par.sh -c localhost -p 52443 -w 1 &
+killed=$!
+./bin/par.sh -c localhost -p 52443 -w 1 &
+stopped=$!
+sleep 0.5
+pkill -KILL -P $killed
+pkill -STOP -P $stopped
+./bin/par.sh -c localhost -p 52443 -w 2
+pkill -CONT -P $stopped
+wait $server
+egrep "^o:" $tmp/out | sed "s/^o://g" | sort -n > $tmp/done
+seq 0 7 | diff - $tmp/done || exit 1
+grep -q "discarding result" $tmp/err || exit 1
+rm -rf $tmp
+# leasing jobs in advance on a node which may get overloaded
+client_test 52441 -w 2 --prefetch 2 --load-probe STOP || exit 1
+# leasing jobs in advance with a changing number of workers
+client_test 52442 -w 2 --prefetch 2 --autoscale 4
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+# jobs/s, dispatch latency percentiles and master CPU time of a server
+# with N local clients on loopback, for each number of clients and each
+# job output size, as JSON; run from the top directory:
+# PYTHONPATH=lib:src tests/scale_bench.py [options] > bench.json
+# latencies come from the server's --metrics-port histogram, so they are
+# bucket interpolations, like Prometheus' histogram_quantile
+
+import os, shutil, socket, subprocess, sys, tempfile, time, urllib
+
+try:
+    import json
+except ImportError: # python < 2.6
+    import simplejson as json
+
+from optparse import OptionParser
+
+parallel = os.path.join(os.path.dirname(sys.argv[0]), "..", "src",
+                        "parallel.py")
+
+my_parser = OptionParser(usage = "Usage: %prog [options] > bench.json")
+my_parser.add_option("--jobs", dest = "nb_jobs", default = 2000, type = "int",
+                     help = "jobs per run (default is 2000)")
+my_parser.add_option("--clients", dest = "clients", default = "1,2,4,8",
+                     help = "numbers of clients to try (default is 1,2,4,8)")
+my_parser.add_option("--workers", dest = "workers", default = 2,
+                     type = "int",
+                     help = "workers (-w) of each client (default is 2)")
+my_parser.add_option("--job-time", dest = "job_time", default = 0.0,
+                     type = "float",
+                     help = "seconds each job sleeps (default is 0)")
+my_parser.add_option("--output-sizes", dest = "output_sizes",
+                     default = "0,1024,65536",
+                     help = ("bytes each job outputs, sizes to try "
+                             "(default is 0,1024,65536)"))
+my_parser.add_option("--port", dest = "port", default = 52500,
+                     type = "int",
+                     help = "port of the server, the metrics use the next one")
+my_parser.add_option("--server-options", dest = "server_options",
+                     default = "", help = "more options for the server")
+my_parser.add_option("--client-options", dest = "client_options",
+                     default = "", help = "more options for the clients")
+(options, optargs) = my_parser.parse_args()
+
+def job_command(job_time, output_size):
+    res = []
+    if job_time > 0:
+        res.append("sleep %g" % job_time)
+    if output_size > 0:
+        res.append("head -c %d /dev/zero" % output_size)
+    if not res:
+        res.append("true")
+    return "; ".join(res) + "\n"
+
+def wait_for_port(port, timeout = 30.0):
+    start = time.time()
+    while time.time() - start < timeout:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            try:
+                s.connect(("127.0.0.1", port))
+                return True
+            except socket.error:
+                time.sleep(0.1)
+        finally:
+            s.close()
+    return False
+
+def scrape(port):
+    try:
+        return urllib.urlopen("http://127.0.0.1:%d/metrics" % port).read()
+    except IOError:
+        return None
+
+# [(upper bound, cumulated count)] of a histogram in a scrape
+def histogram(metrics, name):
+    res = []
+    for line in metrics.splitlines():
+        if line.startswith(name + '_bucket{le="'):
+            bound = line.split('"')[1]
+            if bound == "+Inf":
+                bound = None
+            else:
+                bound = float(bound)
+            res.append((bound, int(line.split()[-1])))
+    return res
+
+# interpolated inside its bucket, None if in the +Inf one or unknown
+def quantile(buckets, q):
+    if not buckets or buckets[-1][1] == 0:
+        return None
+    target = q * buckets[-1][1]
+    (lower, below) = (0.0, 0)
+    for (bound, cumulated) in buckets:
+        if cumulated >= target:
+            if bound is None:
+                return None
+            if cumulated == below:
+                return bound
+            return lower + (bound - lower) * (target - below) / \
+                   (cumulated - below)
+        (lower, below) = (bound, cumulated)
+    return None
+
+def run(work_dir, nb_clients, output_size):
+    jobs_file = os.path.join(work_dir, "jobs")
+    f = open(jobs_file, 'w')
+    cmd = job_command(options.job_time, output_size)
+    for i in xrange(options.nb_jobs):
+        f.write(cmd)
+    f.close()
+    metrics_port = options.port + 1
+    start  = time.time()
+    server = subprocess.Popen([sys.executable, parallel, "-i", jobs_file,
+                               "-o", os.path.join(work_dir, "output"),
+                               "-s", "-w", "0", "-p", str(options.port),
+                               "--metrics-port", str(metrics_port)] +
+                              options.server_options.split())
+    if not wait_for_port(options.port):
+        os.kill(server.pid, 15)
+        server.wait()
+        raise RuntimeError("the server did not start")
+    clients = []
+    for i in range(nb_clients):
+        clients.append(subprocess.Popen([sys.executable, parallel,
+                                         "-c", "127.0.0.1",
+                                         "-p", str(options.port),
+                                         "-w", str(options.workers)] +
+                                        options.client_options.split()))
+    # the last scrape before the server exits has all the jobs
+    metrics = ""
+    while True:
+        (pid, status, usage) = os.wait4(server.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        last = scrape(metrics_port)
+        if last:
+            metrics = last
+        time.sleep(0.1)
+    elapsed = time.time() - start
+    for client in clients:
+        client.wait()
+    dispatch   = histogram(metrics, "par_dispatch_seconds")
+    master_cpu = usage.ru_utime + usage.ru_stime
+    return { "clients"            : nb_clients,
+             "workers_per_client" : options.workers,
+             "jobs"               : options.nb_jobs,
+             "job_time_s"         : options.job_time,
+             "output_bytes"       : output_size,
+             "exit_status"        : os.WEXITSTATUS(status),
+             "elapsed_s"          : elapsed,
+             "jobs_per_s"         : options.nb_jobs / elapsed,
+             "dispatch_p50_s"     : quantile(dispatch, 0.50),
+             "dispatch_p90_s"     : quantile(dispatch, 0.90),
+             "dispatch_p99_s"     : quantile(dispatch, 0.99),
+             "master_cpu_s"       : master_cpu,
+             "master_cpu_per_job_ms" : 1000.0 * master_cpu / options.nb_jobs }
+
+results  = []
+work_dir = tempfile.mkdtemp()
+try:
+    for output_size in map(int, options.output_sizes.split(",")):
+        for nb_clients in map(int, options.clients.split(",")):
+            res = run(work_dir, nb_clients, output_size)
+            sys.stderr.write("%d clients, %d bytes: %.1f jobs/s\n" %
+                             (nb_clients, output_size, res["jobs_per_s"]))
+            results.append(res)
+finally:
+    shutil.rmtree(work_dir)
+print json.dumps(results, indent = 2, sort_keys = True)
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+
+# jobs/s of each spawn engine on tiny commands, run from the top directory:
+# PYTHONPATH=lib:src tests/spawn_bench.py [nb_jobs]
+# (with a big 'ulimit -n' the difference is larger)
+
+import sys, time
+
+from parallel import JobRunner
+
+nb_jobs = 2000
+if len(sys.argv) > 1:
+    nb_jobs = int(sys.argv[1])
+
+for cmd in ["true\n", "echo 1\n"]:
+    for capture in ["pipe", "file"]:
+        for spawn in ["shell", "fast"]:
+            runner = JobRunner(capture, spawn)
+            start  = time.time()
+            for i in xrange(nb_jobs):
+                runner.run(cmd)
+            elapsed = time.time() - start
+            print "%-8s capture=%-4s spawn=%-5s %8.1f jobs/s" % \
+                  (cmd.strip(), capture, spawn, nb_jobs / elapsed)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# time to stage a file on several nodes, all started at the same time,
+# fetching from the server only (like the NFS checkouts of nfs_time.sh)
+# or from the server and each other (DataStage.py); all on loopback with
+# the server and the nodes uploading at most --rate MB/s, the 11 MB/s
+# default is what our NFS server gave (see nfs_results.txt)
+# run from the top directory:
+# tests/stage_bench.py [options]
+
+import os, shutil, subprocess, sys, tempfile, time
+
+from optparse import OptionParser
+
+data_stage = os.path.join(os.path.dirname(sys.argv[0]), "..", "src",
+                          "DataStage.py")
+
+my_parser = OptionParser(usage = "Usage: %prog [options]")
+my_parser.add_option("--sizes", dest = "sizes", default = "1,4,16,64",
+                     help = "file sizes in MB (default is 1,4,16,64)")
+my_parser.add_option("--nodes", dest = "nodes", default = "1,2,4,8",
+                     help = "numbers of nodes (default is 1,2,4,8)")
+my_parser.add_option("--rate", dest = "rate", default = 11.0,
+                     type = "float",
+                     help = "upload limit of each process in MB/s")
+my_parser.add_option("--port", dest = "port", default = 52600,
+                     type = "int", help = "port of the server")
+(options, optargs) = my_parser.parse_args()
+
+# real time of each node
+def get_times(work_dir, nb_nodes, use_peers):
+    nodes = []
+    for i in range(nb_nodes):
+        cmd = [sys.executable, data_stage, "get", "-p", str(options.port),
+               "-r", str(options.rate), "--linger", "3600"]
+        if not use_peers:
+            cmd.append("--no-peers")
+        cmd += ["127.0.0.1", "data", os.path.join(work_dir, "node%d" % i)]
+        nodes.append(subprocess.Popen(cmd, stdout = subprocess.PIPE))
+    # nodes keep serving until all of them are done
+    res = []
+    for node in nodes:
+        res.append(float(node.stdout.readline().split()[1]))
+    for node in nodes:
+        os.kill(node.pid, 15)
+        node.wait()
+    for i in range(nb_nodes):
+        os.remove(os.path.join(work_dir, "node%d" % i))
+    return res
+
+def average(times):
+    return sum(times) / len(times)
+
+print "# stage time (s) averaged on the nodes, uploads limited to %g MB/s" % \
+      options.rate
+print "#size(M) nodes server_only swarm"
+work_dir = tempfile.mkdtemp()
+try:
+    for size in map(int, options.sizes.split(",")):
+        data = os.path.join(work_dir, "data")
+        f = open(data, 'wb')
+        for i in range(size):
+            f.write(os.urandom(1024 * 1024))
+        f.close()
+        server = subprocess.Popen([sys.executable, data_stage, "serve",
+                                   "-p", str(options.port),
+                                   "-r", str(options.rate), data])
+        time.sleep(1.0) # hashing the file
+        try:
+            for nb_nodes in map(int, options.nodes.split(",")):
+                server_only = average(get_times(work_dir, nb_nodes, False))
+                swarm       = average(get_times(work_dir, nb_nodes, True))
+                print "%d %d %.2f %.2f" % (size, nb_nodes, server_only, swarm)
+                sys.stdout.flush()
+        finally:
+            os.kill(server.pid, 15)
+            server.wait()
+finally:
+    shutil.rmtree(work_dir)
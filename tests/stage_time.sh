@@ -0,0 +1,29 @@
+#!/bin/bash
+
+# time fresh file staging from the server to /tmp on several hosts,
+# the DataStage.py counterpart of nfs_time.sh (results in the same format)
+
+# on the server, in the directory of the files made by create_files.sh:
+#   ~/code/par/src/DataStage.py serve 1 2 4 8 16 32 64 128 256 512 1024
+# then start this at the same time on all the nodes of a group,
+# N being the number of nodes of the group (1, 2, 4 or 8):
+#   ~/code/par/tests/stage_time.sh SERVER N
+# tests/stage_bench.py does the same on one machine
+
+# set -x
+
+SERVER=$1
+N=$2
+
+rm -f /tmp/${N}_n_stage.txt
+for i in `echo 1 2 4 8 16 32 64 128 256 512 1024` ; do
+    rm -f /tmp/$i /tmp/stage_$i.txt
+    # keep serving the file to the slower nodes for a while
+    ~/code/par/src/DataStage.py get --linger 60 $SERVER $i /tmp/$i \
+        > /tmp/stage_$i.txt &
+    while [ ! -s /tmp/stage_$i.txt ] ; do
+        sleep 1
+    done
+    cat /tmp/stage_$i.txt >> /tmp/${N}_n_stage.txt
+done
+wait